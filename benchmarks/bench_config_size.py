@@ -0,0 +1,111 @@
+"""
+Benchmark of config handling against config.toml of growing size.
+
+For every fixture size it measures full parse (load_config_content),
+identity scan (load_config_identities), index build (set_config),
+get_state lookups and write path (dump_config).
+
+    python benchmarks/bench_config_size.py -n 20 --size 100 --size 5000
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+from config_fixtures import SIZES, runner_name, runner_token, write_fixture
+from harness import FakeHost, make_runner, summarize
+
+
+def measure(func, iterations: int):
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return summarize(durations)
+
+
+def bench_size(host: FakeHost, size: int, iterations: int):
+    host.reset()
+    write_fixture(host.etc, size)
+    os.replace(os.path.join(host.etc, f"config-{size}.toml"), host.config)
+
+    last = size - 1
+    runner = make_runner(
+        {
+            "api_url": "https://gitlab.example.com",
+            "name": runner_name(last),
+            "token": runner_token(last),
+            "executor": "docker",
+        }
+    )
+    specs = {
+        "last": {"name": runner_name(last), "token": runner_token(last)},
+        "renamed": {"name": "renamed", "token": runner_token(last)},
+        "missing": {"name": "missing", "token": "glrt-missing"},
+    }
+
+    config = runner.load_config_content()
+    result = {
+        "bytes": os.path.getsize(host.config),
+        "load_config_content": measure(runner.load_config_content, iterations),
+        "load_config_identities": measure(runner.load_config_identities, iterations),
+        "set_config": measure(lambda: runner.set_config(config), iterations),
+    }
+    runner.set_config(config)
+    for key, spec in specs.items():
+        spec["current_name"] = None
+        result[f"get_state_{key}"] = measure(
+            lambda: runner.get_state(spec), iterations
+        )
+    result["dump_config"] = measure(lambda: runner.dump_config(config), iterations)
+    result["toml_backend"] = runner.command_results.get("toml_backend")
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("-n", "--iterations", type=int, default=10)
+    parser.add_argument(
+        "--size",
+        type=int,
+        action="append",
+        help="count of runner sections, could be repeated. "
+        f"Default: {', '.join(map(str, SIZES))}",
+    )
+    parser.add_argument("-o", "--output", help="write JSON here, stdout by default")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    host = FakeHost()
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "iterations": options.iterations,
+        },
+        "sizes": {},
+    }
+    try:
+        with host.activate():
+            for size in options.size or SIZES:
+                report["sizes"][str(size)] = bench_size(
+                    host, size, options.iterations
+                )
+    finally:
+        host.cleanup()
+
+    data = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
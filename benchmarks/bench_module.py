@@ -0,0 +1,158 @@
+"""
+Benchmark of gitlab_runner_register module runs.
+
+Every scenario prepares fake host (not measured) and then runs module
+main() once per iteration. Latency percentiles and counts of
+subprocesses and API requests are written as JSON.
+
+    python benchmarks/bench_module.py -n 50 --runner-latency 0.05 -o bench.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+from fake_gitlab_api import FakeGitlabApi
+from harness import FakeHost, run_module, summarize
+
+TOKEN = "glrt-bench"
+NEW_TOKEN = "glrt-bench-rotated"
+
+
+def make_args(api: FakeGitlabApi, options: argparse.Namespace, **kwargs):
+    args = {
+        "api_url": api.url,
+        "name": "bench",
+        "token": TOKEN,
+        "executor": "docker",
+        "default_image": "alpine:latest",
+        "backend": options.backend,
+        "service_probe": options.service_probe,
+    }
+    args.update(kwargs)
+    return args
+
+
+def register(api, options):
+    return make_args(api, options)
+
+
+# Scenario name: (args of setup run or None, args of measured run)
+SCENARIOS = {
+    "noop": (register, register),
+    "first_register": (None, register),
+    "token_mismatch": (
+        register,
+        lambda api, options: make_args(api, options, token=NEW_TOKEN),
+    ),
+    "recreate": (
+        register,
+        lambda api, options: make_args(api, options, recreate=True),
+    ),
+    "absent": (
+        register,
+        lambda api, options: make_args(api, options, state="absent"),
+    ),
+}
+
+
+def run_scenario(name: str, host: FakeHost, api: FakeGitlabApi, options):
+    setup, measured = SCENARIOS[name]
+    latencies = []
+    commands = []
+    api_requests = []
+    changed = []
+    for _ in range(options.iterations):
+        host.reset()
+        if setup:
+            result = run_module(setup(api, options))
+            if result.get("failed"):
+                raise RuntimeError(f"{name} setup failed: {result['msg']}")
+
+        commands_before = host.commands()
+        requests_before = api.requests
+        start = time.perf_counter()
+        result = run_module(measured(api, options))
+        latencies.append(time.perf_counter() - start)
+        if result.get("failed"):
+            raise RuntimeError(f"{name} failed: {result['msg']}")
+
+        commands.append(host.commands() - commands_before)
+        api_requests.append(api.requests - requests_before)
+        changed.append(result["changed"])
+
+    return {
+        "iterations": options.iterations,
+        "latency": summarize(latencies),
+        "subprocesses": summarize(commands),
+        "api_requests": summarize(api_requests),
+        "changed": any(changed),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("-n", "--iterations", type=int, default=20)
+    parser.add_argument(
+        "-s",
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="scenario to run, could be repeated. All by default",
+    )
+    parser.add_argument("--backend", choices=["binary", "api"], default="binary")
+    parser.add_argument(
+        "--service-probe",
+        choices=["auto", "status"],
+        default="auto",
+    )
+    parser.add_argument(
+        "--runner-latency",
+        type=float,
+        default=0,
+        help="seconds fake gitlab-runner sleeps on every call",
+    )
+    parser.add_argument(
+        "--api-latency",
+        type=float,
+        default=0,
+        help="seconds fake Gitlab API sleeps on every request",
+    )
+    parser.add_argument("-o", "--output", help="write JSON here, stdout by default")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    host = FakeHost(runner_latency=options.runner_latency)
+    api = FakeGitlabApi(latency=options.api_latency).start()
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "backend": options.backend,
+            "service_probe": options.service_probe,
+            "runner_latency": options.runner_latency,
+            "api_latency": options.api_latency,
+        },
+        "scenarios": {},
+    }
+    try:
+        with host.activate():
+            for name in options.scenario or list(SCENARIOS):
+                report["scenarios"][name] = run_scenario(name, host, api, options)
+    finally:
+        api.stop()
+        host.cleanup()
+
+    data = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
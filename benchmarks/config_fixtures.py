@@ -0,0 +1,92 @@
+"""
+Deterministic config.toml fixtures of given runner count.
+
+Sections are laid out as gitlab-runner writes them: identity keys
+first, then cache and docker sub-tables with volume lists.
+
+    python benchmarks/config_fixtures.py --output-dir /tmp/fixtures
+"""
+import argparse
+import os
+
+SIZES = (1, 10, 100, 1000, 5000)
+
+GLOBALS = """concurrent = 32
+check_interval = 3
+connection_max_age = "15m0s"
+shutdown_timeout = 0
+
+[session_server]
+  session_timeout = 1800
+"""
+
+RUNNER = """
+[[runners]]
+  name = "runner-{index:05d}"
+  url = "https://gitlab.example.com"
+  id = {id}
+  token = "glrt-{index:020d}"
+  token_obtained_at = 2024-01-01T00:00:00Z
+  token_expires_at = 0001-01-01T00:00:00Z
+  executor = "docker"
+  environment = ["RUNNER_INDEX={index}", "DOCKER_DRIVER=overlay2"]
+  [runners.custom_build_dir]
+  [runners.cache]
+    MaxUploadedArchiveSize = 0
+    [runners.cache.s3]
+    [runners.cache.gcs]
+    [runners.cache.azure]
+  [runners.docker]
+    tls_verify = false
+    image = "alpine:3.{minor}"
+    privileged = false
+    disable_entrypoint_overwrite = false
+    oom_kill_disable = false
+    disable_cache = false
+    volumes = ["/cache", "/var/run/docker.sock:/var/run/docker.sock", \
+"/builds/runner-{index:05d}:/builds:rw"]
+    shm_size = 0
+    network_mtu = 0
+    cpus = "2"
+    memory = "4g"
+    pull_policy = ["if-not-present"]
+"""
+
+
+def runner_name(index: int):
+    return f"runner-{index:05d}"
+
+
+def runner_token(index: int):
+    return f"glrt-{index:020d}"
+
+
+def make_config(size: int):
+    """
+    Text of config.toml with given count of runner sections.
+    """
+    parts = [GLOBALS]
+    for index in range(size):
+        parts.append(RUNNER.format(index=index, id=1000 + index, minor=index % 20))
+    return "".join(parts)
+
+
+def write_fixture(directory: str, size: int):
+    path = os.path.join(directory, f"config-{size}.toml")
+    with open(path, "w") as f:
+        f.write(make_config(size))
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--size", type=int, action="append", help="default: all")
+    options = parser.parse_args(argv)
+    os.makedirs(options.output_dir, exist_ok=True)
+    for size in options.size or SIZES:
+        print(write_fixture(options.output_dir, size))
+
+
+if __name__ == "__main__":
+    main()
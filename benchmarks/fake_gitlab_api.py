@@ -0,0 +1,162 @@
+"""
+Local stub of Gitlab Runner API used by benchmarks.
+
+Tokens starting with 'invalid' are rejected with 403 as revoked tokens are.
+With rate limit set requests over it are rejected with 429 and Retry-After
+header as Gitlab does.
+"""
+import itertools
+import json
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+RUNNER_PATH_RE = re.compile(r"/api/v4/runners/(\d+)$")
+
+
+class FakeGitlabApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_payload(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def send_json(self, status: int, data=None, headers: dict = None):
+        body = b"" if data is None else json.dumps(data).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method: str):
+        api = self.server.api
+        payload = self.read_payload()
+        api.count(method, self.path)
+        retry_after = api.throttle()
+        if retry_after is not None:
+            return self.send_json(
+                429,
+                {"message": "Retry later"},
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+        if api.latency:
+            time.sleep(api.latency)
+
+        token = payload.get("token", "")
+        if token.startswith("invalid"):
+            return self.send_json(403, {"message": "403 Forbidden"})
+
+        if method == "POST" and self.path.endswith("/api/v4/runners/verify"):
+            return self.send_json(
+                200,
+                {"id": api.runner_id(token), "token": token, "token_expires_at": None},
+            )
+        if method == "DELETE" and self.path.endswith("/api/v4/runners/managers"):
+            return self.send_json(204)
+        if method == "DELETE" and self.path.endswith("/api/v4/runners"):
+            return self.send_json(204)
+        m = RUNNER_PATH_RE.search(self.path)
+        if method == "PUT" and m:
+            if not self.headers.get("PRIVATE-TOKEN"):
+                return self.send_json(401, {"message": "401 Unauthorized"})
+            runner_id = int(m.group(1))
+            api.paused[runner_id] = payload.get("paused", False)
+            return self.send_json(
+                200,
+                {"id": runner_id, "paused": api.paused[runner_id]},
+            )
+        return self.send_json(404, {"message": "404 Not Found"})
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+
+class FakeGitlabApi(object):
+    """
+    Stub server running in background thread.
+    Rate limit is token bucket refilled by rate_limit tokens per second
+    and holding up to burst of them. Zero rate_limit disables it.
+    """
+
+    def __init__(self, latency: float = 0, rate_limit: float = 0, burst: int = 1):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.requests = 0
+        self.throttled = 0
+        self.paths = {}
+        # Runner ID to paused flag set by PUT requests
+        self.paused = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        # Authentication token to runner ID, runner is the same for its token
+        self.runners = {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGitlabApiHandler)
+        self.server.daemon_threads = True
+        self.server.api = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, method: str, path: str):
+        with self.lock:
+            self.requests += 1
+            key = f"{method} {path}"
+            self.paths[key] = self.paths.get(key, 0) + 1
+
+    def throttle(self):
+        """
+        Take token of rate limit bucket. Return seconds to wait
+        for next token if bucket is empty, otherwise None.
+        """
+        if not self.rate_limit:
+            return None
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst,
+                self.tokens + (now - self.refilled) * self.rate_limit,
+            )
+            self.refilled = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return None
+            self.throttled += 1
+            return (1 - self.tokens) / self.rate_limit
+
+    def runner_id(self, token: str):
+        with self.lock:
+            if token not in self.runners:
+                self.runners[token] = next(self.ids)
+            return self.runners[token]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,195 @@
+"""
+Stub of gitlab-runner binary used by benchmarks.
+
+Behaviour is scripted with environment variables:
+
+FAKE_RUNNER_CONFIG   path of config.toml to manage
+FAKE_RUNNER_LOG      file to append every invocation to
+FAKE_RUNNER_LATENCY  seconds to sleep on every invocation
+FAKE_RUNNER_STATUS   'running'(default) or 'stopped'
+FAKE_RUNNER_FAIL     comma separated commands which exit with error
+FAKE_RUNNER_JOBS     JSON file of running jobs reported by 'run' per runner
+                     label (short token)
+
+register and unregister talk to Gitlab API given by --url as binary does.
+'run' serves Prometheus metrics on --listen-address and counts config
+reloads on SIGHUP as service does.
+"""
+import json
+import os
+import signal
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+def toml_lib(kind: str):
+    # Imported on demand, module pulls in ansible which is slow to import
+    from gitlab_runner_register import TOML_READERS, TOML_WRITERS, import_toml_lib
+
+    return import_toml_lib(TOML_READERS if kind == "read" else TOML_WRITERS)[1]
+
+
+def get_option(args: list, name: str):
+    if name in args:
+        return args[args.index(name) + 1]
+    return None
+
+
+def call_api(url: str, method: str, path: str, payload: dict):
+    request = urllib.request.Request(
+        url.rstrip("/") + path,
+        data=json.dumps(payload).encode(),
+        method=method,
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            body = response.read()
+    except urllib.error.HTTPError as e:
+        print(
+            f"ERROR: Request failed  status={method} {url.rstrip('/')}{path}: "
+            f"{e.code} {e.reason}",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    return json.loads(body) if body else {}
+
+
+def load_config(path: str):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return toml_lib("read").loads(f.read())
+
+
+def save_config(path: str, config: dict):
+    with open(path, "w") as f:
+        f.write(toml_lib("write").dumps(config))
+
+
+def register(args: list, config_path: str):
+    url = get_option(args, "--url")
+    token = get_option(args, "--token")
+    data = call_api(
+        url,
+        "POST",
+        "/api/v4/runners/verify",
+        {"token": token, "system_id": "s_fake"},
+    )
+    section = {
+        "name": get_option(args, "--name"),
+        "url": url,
+        "id": data["id"],
+        "token": token,
+        "executor": get_option(args, "--executor")
+        or os.environ.get("RUNNER_EXECUTOR", ""),
+    }
+    image = get_option(args, "--docker-image")
+    if image:
+        section["docker"] = {"image": image, "volumes": ["/cache"]}
+
+    config = load_config(config_path)
+    config.setdefault("runners", []).append(section)
+    save_config(config_path, config)
+    print("Runner registered successfully.", file=sys.stderr)
+
+
+def unregister(args: list, config_path: str):
+    name = get_option(args, "--name")
+    config = load_config(config_path)
+    sections = config.get("runners", [])
+    section = next((s for s in sections if s.get("name") == name), None)
+    if section is None:
+        print(f"FATAL: Couldn't unregister runner {name}", file=sys.stderr)
+        sys.exit(1)
+    call_api(
+        section["url"],
+        "DELETE",
+        "/api/v4/runners/managers",
+        {"token": section["token"], "system_id": "s_fake"},
+    )
+    config["runners"] = [s for s in sections if s is not section]
+    save_config(config_path, config)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        jobs = {}
+        path = os.environ.get("FAKE_RUNNER_JOBS")
+        if path and os.path.exists(path):
+            with open(path) as f:
+                jobs = json.load(f)
+        lines = [
+            "# TYPE gitlab_runner_configuration_loaded_total counter",
+            f"gitlab_runner_configuration_loaded_total {self.server.loaded}",
+            "# TYPE gitlab_runner_jobs gauge",
+        ]
+        for runner, count in sorted(jobs.items()):
+            lines.append(
+                'gitlab_runner_jobs{executor_stage="build",'
+                f'runner="{runner}"}} {count}'
+            )
+        body = ("\n".join(lines) + "\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def run(args: list):
+    host, port = get_option(args, "--listen-address").rsplit(":", 1)
+    server = HTTPServer((host, int(port)), MetricsHandler)
+    server.loaded = 1
+
+    def reload(signum, frame):
+        server.loaded += 1
+
+    signal.signal(signal.SIGHUP, reload)
+    server.serve_forever()
+
+
+def main():
+    args = sys.argv[1:]
+    command = args[0] if args else ""
+
+    log = os.environ.get("FAKE_RUNNER_LOG")
+    if log:
+        with open(log, "a") as f:
+            f.write(" ".join(args) + "\n")
+    time.sleep(float(os.environ.get("FAKE_RUNNER_LATENCY") or 0))
+
+    if command in os.environ.get("FAKE_RUNNER_FAIL", "").split(","):
+        print(f"FATAL: {command} failed", file=sys.stderr)
+        sys.exit(1)
+
+    if command == "run":
+        return run(args)
+
+    if command == "status":
+        if os.environ.get("FAKE_RUNNER_STATUS", "running") == "running":
+            print("gitlab-runner: Service is running")
+            return
+        print("gitlab-runner: Service has stopped", file=sys.stderr)
+        sys.exit(1)
+
+    config_path = os.environ["FAKE_RUNNER_CONFIG"]
+    if command == "register":
+        register(args, config_path)
+    elif command == "unregister":
+        unregister(args, config_path)
+    else:
+        print(f"Unknown command {command}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Helpers to drive gitlab_runner_register.main() in-process against
+a fake host: temporary config dir, fake gitlab-runner binary on PATH
+and optional fake Gitlab API.
+"""
+import contextlib
+import io
+import json
+import math
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import gitlab_runner_register as module  # noqa: E402
+from ansible.module_utils import basic  # noqa: E402
+from ansible.module_utils.common import warnings  # noqa: E402
+from ansible.module_utils.common.text.converters import to_bytes  # noqa: E402
+
+FAKE_BINARY = os.path.join(os.path.dirname(__file__), "fake_gitlab_runner.py")
+
+# Module and fake binary write config.toml, stdlib tomllib only reads it
+if module.import_toml_lib(module.TOML_WRITERS)[1] is None:
+    sys.exit(
+        "Benchmarks require a TOML writer, install one of: "
+        + ", ".join(module.TOML_WRITERS)
+    )
+# Module paths redirected to fake host dir
+MODULE_PATHS = (
+    "RUNNER_CONFIG",
+    "RUNNER_ID",
+    "RUNNER_STATE",
+    "RUNNER_TOKEN_CACHE",
+    "RUNNER_LOCK",
+    "RUNNER_SNAPSHOT",
+    "RUNNER_JOURNAL",
+    "RUNNER_APPLIED",
+)
+
+
+class FakeHost(object):
+    """
+    Temporary /etc/gitlab-runner with fake gitlab-runner binary.
+    """
+
+    def __init__(self, runner_latency: float = 0):
+        self.dir = tempfile.mkdtemp(prefix="gitlab-runner-bench-")
+        self.etc = os.path.join(self.dir, "etc")
+        self.bin = os.path.join(self.dir, "bin")
+        self.log = os.path.join(self.dir, "commands.log")
+        self.config = os.path.join(self.etc, "config.toml")
+        self.runner_latency = runner_latency
+        os.makedirs(self.bin)
+
+        self.jobs = os.path.join(self.dir, "jobs")
+        self.service = None
+        self.metrics_url = None
+
+        # Name of service process is checked by service probe. Other commands
+        # keep interpreter name to find their virtualenv.
+        wrapper = os.path.join(self.bin, "gitlab-runner")
+        with open(wrapper, "w") as f:
+            f.write(
+                "#!/bin/bash\n"
+                'if [ "$1" = run ]; then\n'
+                f'  exec -a gitlab-runner "{sys.executable}" "{FAKE_BINARY}" "$@"\n'
+                "fi\n"
+                f'exec "{sys.executable}" "{FAKE_BINARY}" "$@"\n'
+            )
+        os.chmod(wrapper, os.stat(wrapper).st_mode | stat.S_IEXEC)
+        self.reset()
+
+    def reset(self):
+        """
+        Drop config and state files. System ID is kept.
+        """
+        shutil.rmtree(self.etc, ignore_errors=True)
+        os.makedirs(self.etc)
+        with open(os.path.join(self.etc, ".runner_system_id"), "w") as f:
+            f.write("s_fake\n")
+        open(self.log, "w").close()
+
+    def commands(self):
+        """
+        Count of fake binary invocations since last reset.
+        """
+        with open(self.log) as f:
+            return sum(1 for line in f)
+
+    def set_jobs(self, token: str, count: int):
+        """
+        Count of running jobs of runner reported by fake service metrics.
+        """
+        jobs = {}
+        if os.path.exists(self.jobs):
+            with open(self.jobs) as f:
+                jobs = json.load(f)
+        jobs[short_token(token)] = count
+        with open(self.jobs, "w") as f:
+            json.dump(jobs, f)
+
+    def start_service(self):
+        """
+        Start fake 'gitlab-runner run' process serving metrics.
+        """
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        self.metrics_url = f"http://127.0.0.1:{port}/metrics"
+        env = dict(os.environ, FAKE_RUNNER_JOBS=self.jobs)
+        self.service = subprocess.Popen(
+            [
+                os.path.join(self.bin, "gitlab-runner"),
+                "run",
+                "--config",
+                self.config,
+                "--listen-address",
+                f"127.0.0.1:{port}",
+            ],
+            env=env,
+        )
+        # Wait for metrics endpoint
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                return self.service.pid
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("Fake service didn't start")
+
+    def stop_service(self):
+        if self.service is not None:
+            self.service.terminate()
+            self.service.wait()
+            self.service = None
+
+    def cleanup(self):
+        self.stop_service()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """
+        Redirect module paths and PATH to fake host.
+        """
+        saved_paths = {name: getattr(module, name) for name in MODULE_PATHS}
+        saved_env = dict(os.environ)
+        for name in MODULE_PATHS:
+            path = os.path.join(self.etc, os.path.basename(saved_paths[name]))
+            setattr(module, name, path)
+        os.environ["PATH"] = self.bin + os.pathsep + os.environ.get("PATH", "")
+        os.environ["FAKE_RUNNER_CONFIG"] = self.config
+        os.environ["FAKE_RUNNER_LOG"] = self.log
+        os.environ["FAKE_RUNNER_LATENCY"] = str(self.runner_latency)
+        try:
+            yield self
+        finally:
+            for name, path in saved_paths.items():
+                setattr(module, name, path)
+            os.environ.clear()
+            os.environ.update(saved_env)
+
+
+def short_token(token: str):
+    """
+    Runner label of metrics as gitlab-runner makes it.
+    """
+    for prefix in module.RUNNER_TOKEN_PREFIXES:
+        if token.startswith(prefix):
+            token = token[len(prefix) :]
+            break
+    return token[: module.RUNNER_SHORT_TOKEN_LENGTH]
+
+
+def set_module_args(args: dict):
+    payload = {"ANSIBLE_MODULE_ARGS": args}
+    basic._ANSIBLE_ARGS = to_bytes(json.dumps(payload))
+    # Required by ansible-core 2.19+, ignored by older ones
+    basic._ANSIBLE_PROFILE = "legacy"
+    # Warnings are collected per process, drop those of previous runs
+    for name in ("_global_warnings", "_global_deprecations"):
+        getattr(warnings, name, {}).clear()
+
+
+def run_module(args: dict):
+    """
+    Run module main() with given args and return its result.
+    """
+    set_module_args(args)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            module.main()
+        except SystemExit:
+            pass
+    lines = [line for line in output.getvalue().splitlines() if line.strip()]
+    return json.loads(lines[-1])
+
+
+def make_runner(args: dict):
+    """
+    Build module object and Runner for given args without running act().
+    """
+    set_module_args(args)
+    return module.Runner(module.setup_module_object())
+
+
+def percentile(values: list, pct: float):
+    """
+    Nearest-rank percentile.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(math.ceil(pct / 100.0 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+def summarize(values: list):
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "min": min(values),
+        "max": max(values),
+        "mean": sum(values) / len(values),
+    }
@@ -0,0 +1,178 @@
+"""
+Load test of fleet registration against rate limited Gitlab API stub.
+
+Every simulated host is a separate process with its own fake
+/etc/gitlab-runner which runs module once to register its runner.
+Hosts share one local API stub which rejects requests over rate limit
+with 429. Throughput, error rates and time until all runners are
+registered are written as JSON.
+
+    python benchmarks/load_register.py --hosts 200 --concurrency 50 --rate-limit 20
+"""
+import argparse
+import collections
+import json
+import multiprocessing
+import platform
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fake_gitlab_api import FakeGitlabApi
+from harness import FakeHost, run_module, summarize
+
+HTTP_STATUS_RE = re.compile(r"\b([45]\d\d)\b")
+
+
+def error_kind(result: dict):
+    """
+    HTTP status of failed registration if known, 'other' otherwise.
+    """
+    if result.get("status"):
+        return str(result["status"])
+    m = HTTP_STATUS_RE.search(result.get("stderr") or "")
+    return m.group(1) if m else "other"
+
+
+def register_host(index: int, api_url: str, options: dict):
+    """
+    Register runner of one simulated host. Run in worker process.
+    """
+    host = FakeHost(runner_latency=options["runner_latency"])
+    args = {
+        "api_url": api_url,
+        "name": f"host-{index:05d}",
+        "token": f"glrt-host-{index:05d}",
+        "executor": "shell",
+        "backend": options["backend"],
+        "service_probe": "auto",
+    }
+    args.update(options["module_args"])
+    try:
+        with host.activate():
+            start = time.monotonic()
+            result = run_module(args)
+            end = time.monotonic()
+    finally:
+        host.cleanup()
+    return {
+        "start": start,
+        "end": end,
+        "failed": bool(result.get("failed")),
+        "error": error_kind(result) if result.get("failed") else None,
+        "msg": result.get("msg"),
+        "retry_attempts": result.get("retry_attempts", 0),
+        "backoff_time": result.get("backoff_time", 0),
+    }
+
+
+def run_load(options):
+    api = FakeGitlabApi(
+        latency=options.api_latency,
+        rate_limit=options.rate_limit,
+        burst=options.burst,
+    ).start()
+    worker_options = {
+        "runner_latency": options.runner_latency,
+        "backend": options.backend,
+        "module_args": options.module_args,
+    }
+    context = multiprocessing.get_context("fork")
+    try:
+        with ProcessPoolExecutor(options.concurrency, mp_context=context) as pool:
+            started = time.monotonic()
+            futures = [
+                pool.submit(register_host, index, api.url, worker_options)
+                for index in range(options.hosts)
+            ]
+            hosts = [future.result() for future in futures]
+            elapsed = time.monotonic() - started
+    finally:
+        api.stop()
+
+    registered = [h for h in hosts if not h["failed"]]
+    errors = collections.Counter(h["error"] for h in hosts if h["failed"])
+    last = max((h["end"] for h in registered), default=None)
+    return {
+        "hosts": options.hosts,
+        "registered": len(registered),
+        "failed": options.hosts - len(registered),
+        "error_rate": (options.hosts - len(registered)) / options.hosts,
+        "errors": dict(errors),
+        "elapsed": elapsed,
+        "throughput": len(registered) / elapsed,
+        # Only meaningful if every host succeeded
+        "time_to_all_registered": (
+            last - started if len(registered) == options.hosts else None
+        ),
+        "host_latency": summarize([h["end"] - h["start"] for h in hosts]),
+        "api_requests": api.requests,
+        "api_throttled": api.throttled,
+        "retry_attempts": sum(h["retry_attempts"] for h in hosts),
+        "backoff_time": summarize([h["backoff_time"] for h in hosts]),
+        "sample_errors": sorted({h["msg"] for h in hosts if h["failed"]})[:5],
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--hosts", type=int, default=100)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=20,
+        help="count of hosts registering at the same time",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=10,
+        help="API requests per second accepted by stub, 0 disables limit",
+    )
+    parser.add_argument(
+        "--burst",
+        type=int,
+        default=10,
+        help="API requests accepted at once before rate limit applies",
+    )
+    parser.add_argument("--backend", choices=["binary", "api"], default="api")
+    parser.add_argument("--runner-latency", type=float, default=0)
+    parser.add_argument("--api-latency", type=float, default=0)
+    parser.add_argument(
+        "--module-args",
+        type=json.loads,
+        default={},
+        help="JSON object of extra module options, e.g. retry settings",
+    )
+    parser.add_argument("-o", "--output", help="write JSON here, stdout by default")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "concurrency": options.concurrency,
+            "rate_limit": options.rate_limit,
+            "burst": options.burst,
+            "backend": options.backend,
+            "runner_latency": options.runner_latency,
+            "api_latency": options.api_latency,
+            "module_args": options.module_args,
+        },
+        "result": run_load(options),
+    }
+
+    data = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,7 +11,8 @@ short_description: Configure Gitlab Runner
 description:
   - Register, unregister and re-register the Gitlab Runner instance.
   - For now if you need to change some config parameters
-    you will have to re-register the instance.
+    you will have to re-register the instance unless
+    update_in_place is used.
   - Also if you change the token then re-registration occurs as well.
   - Note that runner authentication token is used.
     NOT registration token which is deprecated. See bellow.
@@ -33,13 +34,22 @@ notes:
     and with no yaml programming though...
 
 requirements:
-  - python-toml
+  - One of tomllib(python 3.11+), rtoml, tomli or toml to read config.
+  - One of rtoml, tomli_w or toml to write config.
 
 attributes:
   check_mode:
-    support: none
+    support: full
+    details:
+      - No commands are run and nothing is written. Service is checked
+        by looking for its process only.
   diff_mode:
-    support: none
+    support: full
+    details:
+      - Before and after text of affected runner sections and global params
+        is shown with tokens and secrets masked.
+      - After text is planned content. Keys which gitlab-runner adds itself
+        on registration aren't shown.
 
 options:
   api_url:
@@ -57,8 +67,55 @@ options:
   name:
     description:
       - Name of Runner instance
-    required: true
+      - Required unless runners option is used.
+    required: false
+    type: str
+  token:
+    description:
+      - Runner authentication token.
+      - Required unless runners option is used.
+    required: false
     type: str
+  runners:
+    description:
+      - List of Runner instances to manage with one module invocation.
+      - Config file is parsed and service is checked only once for all of them.
+      - Options not set in item are taken from top-level options of the module.
+      - Mutually exclusive with name and token options.
+    required: false
+    type: list
+    elements: dict
+    suboptions:
+      name:
+        description: Name of Runner instance.
+        required: true
+        type: str
+      token:
+        description: Runner authentication token.
+        required: true
+        type: str
+      state:
+        description: Desired state of Runner instance.
+        choices: ["present", "absent"]
+        type: str
+      executor:
+        description: Runner executor mode.
+        type: str
+      default_image:
+        description: Default image of Runner instance.
+        type: str
+      environ_vars:
+        description: Env params to build config while registering instance.
+        type: dict
+      template_file:
+        description: Template to build config while registering instance.
+        type: str
+      recreate:
+        description: Force recreate Runner instance with specified params.
+        type: bool
+      runner_params:
+        description: Params of runner section in config file.
+        type: dict
   executor:
     description:
       - Runner executor mode.
@@ -74,20 +131,38 @@ options:
     description:
       - Options that could be set to override default globals of config file
       - Applied only on instance registration. To change existing runner reregister required.
+      - Not applied if config file already holds other registered runners.
+      - If not set, default globals are written in C(replace) mode and
+        nothing is merged in C(merge) mode.
       - You could find valid params at Gitlab Runner documentation.
     required: false
     type: dict
+  global_params_mode:
+    description:
+      - How global_params are applied to config file.
+      - C(replace) writes config file with global_params only before runner
+        registration. Applied only if config file holds no other runners.
+      - C(merge) merges global_params into top-level keys and tables of
+        existing config file on every run. Runner sections are kept.
+        Config file isn't written if nothing changed.
+    required: false
+    default: replace
+    choices: ["replace", "merge"]
+    type: str
   environ_vars:
     description:
       - You could set those env params to build config while registering instance.
-      - Applied only on instance registration. To change existing runner reregister required.
+      - Applied only on instance registration. To change existing runner reregister
+        required unless update_in_place is set. Only common ENVs of runner, docker,
+        kubernetes and cache settings are applied in place.
       - You could view all values running 'gitlab-runner register --help' command.
     required: false
     type: dict
   template_file:
     description:
       - Place that template to build config while registering instance.
-      - Applied only on instance registration. To change existing runner reregister required.
+      - Applied only on instance registration. To change existing runner reregister
+        required unless update_in_place is set.
       - You could find out how to make it at gitlab runner documentation.
     required: false
     type: str
@@ -98,6 +173,234 @@ options:
     required: false
     default: false
     type: bool
+  runner_params:
+    description:
+      - Params of runner section in config file, i.e. limit, request_concurrency
+        or docker block.
+      - Applied right after instance registration.
+      - To change existing runner reregister required unless update_in_place is set.
+      - Runner identity keys(name, url, id, token) can't be set here.
+    required: false
+    type: dict
+  backend:
+    description:
+      - How to register and unregister runners.
+      - C(binary) runs 'gitlab-runner register' and 'gitlab-runner unregister'.
+      - C(api) verifies authentication token with Gitlab API directly and writes
+        runner section to config file without running binary. One HTTP
+        connection is reused for all runners of module run.
+      - Runners with environ_vars are always handled by binary since those
+        ENVs are interpreted by gitlab-runner itself.
+      - Proxy environment variables aren't used by C(api).
+    required: false
+    default: binary
+    choices: ["binary", "api"]
+    type: str
+  validate_certs:
+    description:
+      - Verify TLS certificate of Gitlab Server when backend is C(api).
+    required: false
+    default: true
+    type: bool
+  verify_token:
+    description:
+      - Verify token with Gitlab API before unregistering runner
+        on re-registration.
+      - Tokens of all runners to re-register are verified before any runner
+        is changed. If one is invalid or revoked module fails and all runners
+        are left as is.
+    required: false
+    default: false
+    type: bool
+  token_cache_ttl:
+    description:
+      - Seconds to keep result of token verification on host.
+      - Runners sharing same token and repeated runs don't hit API again
+        while result is cached. Set C(0) to disable the cache.
+    required: false
+    default: 3600
+    type: int
+  profile_dir:
+    description:
+      - Profile module run with cProfile and write stats to this directory
+        on target host. Top entries by cumulative time are returned in
+        profile.
+      - Could be set with GITLAB_RUNNER_REGISTER_PROFILE environment
+        variable of the task as well. Then argument parsing is profiled too.
+    required: false
+    type: path
+  profile_top:
+    description:
+      - Count of top entries by cumulative time returned in profile.
+    required: false
+    default: 20
+    type: int
+  service_probe:
+    description:
+      - How to verify that gitlab-runner service is running.
+      - C(auto) looks for service process in systemd unit cgroup, pid file
+        and /proc without running any command. Only process of module's PID
+        namespace using managed config.toml is accepted, so runners of
+        containers don't count. If process isn't found there it falls back
+        to C(status).
+      - C(status) always runs 'gitlab-runner status'.
+    required: false
+    default: auto
+    choices: ["auto", "status"]
+    type: str
+  skip_unchanged:
+    description:
+      - Store hash of module inputs and config file stat next to config file
+        after successful run.
+      - When both are the same on next run, module exits without checking
+        the service, parsing config file or running gitlab-runner binary.
+      - Never applied when recreate is set.
+    required: false
+    default: false
+    type: bool
+  update_in_place:
+    description:
+      - Update runner section in config file when keys set by executor,
+        default_image, runner_params, template_file or environ_vars differ
+        from the current ones.
+      - Token and system ID of registered runner are kept. No re-registration occurs.
+      - Keys applied last time are stored next to config file. Keys which
+        aren't desired any more are removed, keys added by gitlab-runner
+        itself are kept.
+    required: false
+    default: false
+    type: bool
+  rollback_on_failure:
+    description:
+      - Restore config file as it was before module run if runner
+        registration or unregistration fails, or any other error happens
+        once config file is about to change.
+      - Config file is saved to snapshot next to it before first change in
+        any case, and actions planned for runners are recorded in journal.
+        If run is interrupted, next run completes actions left, e.g. drops
+        or renames replacement runner of make_before_break.
+      - Runner unregistered at Gitlab with authentication token keeps working
+        with restored config, as Gitlab creates runner manager again on its
+        first request. It isn't so for legacy runner tokens.
+    required: false
+    default: false
+    type: bool
+  drain_timeout:
+    description:
+      - Seconds to wait for running jobs to finish before runner is
+        unregistered. Runner is paused first, so it doesn't take new jobs.
+      - Running jobs are read from gitlab_runner_jobs of metrics_url, which
+        is required then. Only jobs of the runner are counted, they're told
+        apart by runner label holding its short token.
+      - Runner is unregistered when timeout expires even if jobs are left.
+      - Set C(0) to unregister at once.
+    required: false
+    default: 0
+    type: float
+  drain_pause:
+    description:
+      - How runner is paused before drain.
+      - C(config) takes runner section out of config file and reloads service,
+        so service stops requesting jobs for it while running jobs go on.
+        Runner is unregistered by backend then. With C(binary) the section
+        is written back right before gitlab-runner unregisters it.
+      - C(api) pauses runner with Gitlab API using api_token. Note that the
+        whole runner is paused, i.e. on all hosts sharing its token.
+        Runner re-registered with the same token is unpaused, runner of
+        new token is left as is.
+    required: false
+    default: config
+    choices: ["config", "api"]
+    type: str
+  api_token:
+    description:
+      - Gitlab access token allowed to manage runner. Used by C(api)
+        drain_pause only and required by it if drain_timeout is set.
+    required: false
+    type: str
+  make_before_break:
+    description:
+      - On re-registration register replacement runner under temporary name
+        first, confirm Gitlab accepts it and only then unregister old runner
+        and rename replacement to runner name.
+      - Host keeps registered runner all the time. If registration of
+        replacement fails old runner is left as is.
+      - If token is the same, runner manager at Gitlab side is shared by old
+        and replacement runner, so only old section is removed from config.
+    required: false
+    default: false
+    type: bool
+  reload_service:
+    description:
+      - Send SIGHUP to gitlab-runner service process after config file was
+        changed, so new config is applied at once instead of on next cycle
+        of service file watcher.
+      - Process is looked up the same way as by C(auto) service_probe.
+      - If metrics_url is set, module waits until configuration loaded
+        counter of service grows or reload_timeout expires.
+    required: false
+    default: false
+    type: bool
+  reload_timeout:
+    description:
+      - Seconds to wait for service to confirm config reload.
+      - Module warns and doesn't fail if reload isn't confirmed in time.
+    required: false
+    default: 10
+    type: float
+  metrics_url:
+    description:
+      - URL of Prometheus metrics endpoint of gitlab-runner service
+        (see listen_address of global_params), e.g.
+        C(http://127.0.0.1:9252/metrics).
+    required: false
+    type: str
+  system_id_timeout:
+    description:
+      - Seconds to wait for gitlab-runner service to create its system ID
+        file when it's missing, e.g. on freshly booted host.
+      - Module returns as soon as the file appears. Directory is watched with
+        inotify, it's polled if inotify isn't available.
+      - Set C(0) to fail at once if the file is missing.
+    required: false
+    default: 60
+    type: float
+  lock_timeout:
+    description:
+      - Seconds to wait for lock of other module run on the same host.
+      - Lock file next to config file is locked for the whole run, so
+        overlapping runs don't register the same runner twice or overwrite
+        config file of each other.
+      - Module fails if lock isn't acquired in time. Set C(0) to fail at once.
+      - Lock isn't taken in check mode.
+    required: false
+    default: 300
+    type: float
+  retries:
+    description:
+      - Count of retries of runner registration and unregistration
+        which failed with transient error.
+      - Transient errors are HTTP statuses 408, 429, 500, 502, 503 and 504
+        of Gitlab API and network errors. For C(binary) backend they are
+        recognized by output of gitlab-runner.
+    required: false
+    default: 0
+    type: int
+  retry_delay:
+    description:
+      - Base delay of exponential backoff between retries in seconds.
+      - Delay before retry N is random in range from 0 to
+        retry_delay * 2^(N-1), limited by retry_max_delay.
+      - Retry-After header of Gitlab API response is honoured.
+    required: false
+    default: 1
+    type: float
+  retry_max_delay:
+    description:
+      - Upper limit of delay between retries in seconds.
+    required: false
+    default: 30
+    type: float
 """
 
 EXAMPLES = r"""
@@ -133,6 +436,35 @@ EXAMPLES = r"""
     default_image: "alpine:latest"
     recreate: true
 
+- name: Change runner config without re-registration
+  gitlab_runner_register:
+    api_url: "{{ gitlab_url }}"
+    token: "{{ gitlab_runner_token }}"
+    name: "{{ ansible_hostname }}"
+    executor: "docker"
+    default_image: "alpine:3.20"
+    runner_params:
+      limit: 4
+      docker:
+        memory: "2g"
+        volumes: ["/cache"]
+    update_in_place: true
+
+- name: Register several runners at once
+  gitlab_runner_register:
+    api_url: "{{ gitlab_url }}"
+    executor: "docker"
+    default_image: "alpine:latest"
+    runners:
+      - name: "{{ ansible_hostname }}-build"
+        token: "{{ gitlab_build_token }}"
+      - name: "{{ ansible_hostname }}-deploy"
+        token: "{{ gitlab_deploy_token }}"
+        default_image: "debian:bookworm"
+      - name: "{{ ansible_hostname }}-old"
+        token: "{{ gitlab_old_token }}"
+        state: absent
+
 - name: Register runner with environments params
   gitlab_runner_register:
     api_url: "{{ gitlab_url }}"
@@ -179,292 +511,2577 @@ changed:
   type: bool
 runner_state:
   description: Return current state of Runner
-  returned: always
+  returned: when name option is used
   type: str
 msg:
   description: Action done with reregistration
   returned: when registering fist time, unregistering or reregistering
   type: str
+service_probe:
+  description: Backend that verified service state and time it took.
+  returned: when service is checked
+  type: dict
+  contains:
+    backend:
+      description: One of cgroup, pidfile, proc or status.
+      type: str
+    pid:
+      description: PID of service process if backend found it.
+      type: int
+    duration:
+      description: Probe duration in seconds.
+      type: float
+system_id_wait:
+  description: How system ID file was waited for and time it took.
+  returned: when system ID file was missing at start
+  type: dict
+  contains:
+    backend:
+      description: One of inotify or poll.
+      type: str
+    duration:
+      description: Wait duration in seconds.
+      type: float
+service_reload:
+  description: Result of config reload of service.
+  returned: when reload_service is set and config file was changed
+  type: dict
+  contains:
+    pid:
+      description: PID of service process signaled.
+      type: int
+    confirmed:
+      description: Whether service confirmed reload. Null if metrics_url isn't set.
+      type: bool
+    duration:
+      description: Time in seconds from signal to confirmation.
+      type: float
+toml_backend:
+  description: TOML libs used to read and write config.
+  returned: when config is read or written
+  type: dict
+  sample: {"read": "tomllib", "write": "toml"}
+globals_updated:
+  description: Whether global_params were merged into config file.
+  returned: when global_params_mode is merge
+  type: bool
+timings:
+  description: Wall-clock duration of module phases in seconds.
+  returned: always
+  type: dict
+  sample: {"check_service": 0.0004, "get_state": 0.00001, "register_runner": 0.81}
+commands_run:
+  description: Count of external commands run by module.
+  returned: always
+  type: int
+api_requests:
+  description: Count of requests sent to Gitlab API.
+  returned: always
+  type: int
+profile:
+  description: Profile stats of module run.
+  returned: when profile_dir is set
+  type: dict
+  contains:
+    path:
+      description: Path of stats file on target host. Load it with pstats.
+      type: str
+    top:
+      description: Top entries by cumulative time.
+      type: list
+      elements: dict
+rolled_back:
+  description: Whether config file was restored from snapshot after failure.
+  returned: on failure when rollback_on_failure is set and config was changed
+  type: bool
+resumed:
+  description: Names of runners with actions left by interrupted previous run.
+  returned: when previous run was interrupted
+  type: list
+  elements: str
+lock_wait:
+  description: Time in seconds spent waiting for lock of other module run.
+  returned: always
+  type: float
+retry_attempts:
+  description: Count of retried registration and unregistration attempts.
+  returned: always
+  type: int
+backoff_time:
+  description: Total time in seconds spent waiting between retries.
+  returned: always
+  type: float
+cache_hit:
+  description: Whether run was skipped because inputs and config file are unchanged.
+  returned: when skip_unchanged is set
+  type: bool
+runners:
+  description: Per Runner results.
+  returned: always
+  type: list
+  elements: dict
+  contains:
+    name:
+      description: Name of Runner instance.
+      type: str
+    runner_state:
+      description: Current state of Runner instance.
+      type: str
+    action:
+      description: Action done with Runner instance or planned in check mode.
+      type: str
+      sample: register
+    changed:
+      description: Whether Runner instance was changed.
+      type: bool
+    msg:
+      description: Action done with Runner instance.
+      type: str
+    token_check:
+      description: Where token verification result came from, api or cache.
+      type: str
+      returned: when token was verified
+    drain:
+      description: How Runner instance was drained before unregistration.
+      type: dict
+      returned: when runner was drained
+      contains:
+        pause:
+          description: How runner was paused, config or api.
+          type: str
+        duration:
+          description: Drain duration in seconds.
+          type: float
+        jobs_left:
+          description: Running jobs left when drain ended. Null if unknown.
+          type: int
+        runner_id:
+          description: >-
+            ID of runner paused with API. It's unpaused only if runner is
+            registered again under the same ID, i.e. with the same token.
+          type: int
+    retry_attempts:
+      description: Count of retried attempts for Runner instance.
+      type: int
+      returned: when any attempt was retried
+    backoff_time:
+      description: Time in seconds spent waiting between retries for Runner instance.
+      type: float
+      returned: when any attempt was retried
 """
+import copy
+import cProfile
+import ctypes
+import errno
+import fcntl
+import functools
+import hashlib
+import http.client
+import importlib
+import json
+import mmap
 import os
+import pstats
+import random
 import re
+import select
+import signal
+import ssl
 import tempfile
+import time
 import traceback
+from datetime import datetime, timezone
 from enum import Enum
+from urllib.parse import urlsplit
 
 from ansible.module_utils.basic import AnsibleModule, missing_required_lib
-from ansible.module_utils.common.text.converters import to_text
+from ansible.module_utils.common.text.converters import to_bytes, to_text
 
-TOML_IMP_ERR = None
-try:
-    import toml
+# Lines of config file which runner section scanner relies on
+RUNNER_HEADER_RE = re.compile(
+    rb"^[ \t]*\[\[[ \t]*runners[ \t]*\]\][ \t\r]*(?:#.*)?$",
+    re.M,
+)
+TABLE_HEADER_RE = re.compile(rb"^[ \t]*\[", re.M)
+RUNNER_IDENTITY_RE = re.compile(
+    rb"^[ \t]*(name|token)[ \t]*=[ \t]*"
+    rb"(\"(?:[^\"\\\n]|\\.)*\"|'[^'\n]*')[ \t\r]*(?:#.*)?$",
+    re.M,
+)
 
-    HAS_TOML = True
-except ImportError:
-    TOML_IMP_ERR = traceback.format_exc()
-    HAS_TOML = False
+# TOML libs in order of preference. Imported on first use only.
+TOML_READERS = ("tomllib", "rtoml", "tomli", "toml")
+TOML_WRITERS = ("rtoml", "tomli_w", "toml")
+TOML_LIBS = {}
 
 RUNNER_CONFIG = "/etc/gitlab-runner/config.toml"
 RUNNER_ID = "/etc/gitlab-runner/.runner_system_id"
+RUNNER_STATE = "/etc/gitlab-runner/.ansible_runner_state.json"
+RUNNER_TOKEN_CACHE = "/etc/gitlab-runner/.ansible_token_cache.json"
+RUNNER_LOCK = "/etc/gitlab-runner/.ansible_runner.lock"
+RUNNER_SNAPSHOT = "/etc/gitlab-runner/.ansible_config_snapshot.toml"
+RUNNER_JOURNAL = "/etc/gitlab-runner/.ansible_runner_journal.json"
+RUNNER_APPLIED = "/etc/gitlab-runner/.ansible_last_applied.json"
+# Bump when content of RUNNER_STATE changes
+RUNNER_STATE_VERSION = 1
+# Bump when content of RUNNER_JOURNAL changes
+RUNNER_JOURNAL_VERSION = 1
+# Bump when content of RUNNER_APPLIED changes
+RUNNER_APPLIED_VERSION = 1
+RUNNER_SERVICE_CGROUPS = (
+    # cgroup v2 and v1 layouts of systemd
+    "/sys/fs/cgroup/system.slice/gitlab-runner.service/cgroup.procs",
+    "/sys/fs/cgroup/systemd/system.slice/gitlab-runner.service/cgroup.procs",
+)
+RUNNER_PID_FILES = ("/run/gitlab-runner.pid", "/var/run/gitlab-runner.pid")
+
+# Per runner options which fall back to top-level module options
+RUNNER_DEFAULT_OPTIONS = (
+    "state",
+    "executor",
+    "default_image",
+    "environ_vars",
+    "template_file",
+    "recreate",
+    "runner_params",
+)
+# Runner identity keys which are owned by gitlab-runner
+RUNNER_IDENTITY_KEYS = ("name", "url", "id", "token")
+# Registration ENVs of gitlab-runner applied in place and keys they set
+RUNNER_ENV_KEYS = {
+    "RUNNER_EXECUTOR": (("executor",), str),
+    "RUNNER_SHELL": (("shell",), str),
+    "RUNNER_BUILDS_DIR": (("builds_dir",), str),
+    "RUNNER_CACHE_DIR": (("cache_dir",), str),
+    "RUNNER_LIMIT": (("limit",), int),
+    "RUNNER_OUTPUT_LIMIT": (("output_limit",), int),
+    "RUNNER_REQUEST_CONCURRENCY": (("request_concurrency",), int),
+    "DOCKER_IMAGE": (("docker", "image"), str),
+    "DOCKER_PRIVILEGED": (("docker", "privileged"), bool),
+    "DOCKER_TLS_VERIFY": (("docker", "tls_verify"), bool),
+    "DOCKER_DISABLE_CACHE": (("docker", "disable_cache"), bool),
+    "DOCKER_MEMORY": (("docker", "memory"), str),
+    "DOCKER_CPUS": (("docker", "cpus"), str),
+    "DOCKER_CPUSET_CPUS": (("docker", "cpuset_cpus"), str),
+    "DOCKER_SHM_SIZE": (("docker", "shm_size"), int),
+    "DOCKER_NETWORK_MODE": (("docker", "network_mode"), str),
+    "KUBERNETES_NAMESPACE": (("kubernetes", "namespace"), str),
+    "KUBERNETES_IMAGE": (("kubernetes", "image"), str),
+    "CACHE_TYPE": (("cache", "Type"), str),
+    "CACHE_PATH": (("cache", "Path"), str),
+    "CACHE_SHARED": (("cache", "Shared"), bool),
+}
+# Defaults written by 'gitlab-runner register' for docker executors
+RUNNER_DOCKER_DEFAULTS = {
+    "tls_verify": False,
+    "image": "",
+    "privileged": False,
+    "disable_entrypoint_overwrite": False,
+    "oom_kill_disable": False,
+    "disable_cache": False,
+    "volumes": ["/cache"],
+    "shm_size": 0,
+    "network_mtu": 0,
+}
+# Values of matching keys are masked in diff
+SECRET_KEY_RE = re.compile(r"token|secret|password", re.I)
+SECRET_MASK = "********"
+# Token without expiration as written by gitlab-runner
+RUNNER_TOKEN_NO_EXPIRE = datetime(1, 1, 1, tzinfo=timezone.utc)
+API_TIMEOUT = 30
+PROFILE_ENV = "GITLAB_RUNNER_REGISTER_PROFILE"
+# Seconds between attempts to take lock held by other run
+LOCK_POLL_INTERVAL = 0.1
+# Counter of gitlab-runner metrics incremented on every config load
+RUNNER_RELOAD_METRIC = "gitlab_runner_configuration_loaded_total"
+# Gauge of gitlab-runner metrics holding running jobs
+RUNNER_JOBS_METRIC = "gitlab_runner_jobs"
+# Runner label of metrics is token shortened to this length
+# without its prefix
+RUNNER_SHORT_TOKEN_LENGTH = 8
+RUNNER_TOKEN_PREFIXES = ("glrt-", "GR1348941")
+METRIC_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+# Seconds between checks of running jobs while draining
+DRAIN_POLL_INTERVAL = 1
+METRICS_TIMEOUT = 5
+# Seconds between checks of metrics while waiting for service
+METRICS_POLL_INTERVAL = 0.2
+# Seconds between checks of system ID file if inotify isn't available
+SYSTEM_ID_POLL_INTERVAL = 0.5
+# inotify(7) constants
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+RUNNER_AUTH_TOKEN_PREFIX = "glrt-"
+# Suffix of temporary name of replacement runner in make-before-break mode
+RUNNER_REPLACEMENT_SUFFIX = "-replacement"
+# At least one of them is required to build runner config
+RUNNER_CONFIG_OPTIONS = ("executor", "template_file", "environ_vars")
+# HTTP statuses of transient Gitlab errors which are retried
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+# Output of gitlab-runner on transient Gitlab or network errors. Status
+# code counts only followed by its reason phrase, e.g. 'status=502 Bad
+# Gateway', as other numbers like pid=502 are printed too.
+RETRYABLE_OUTPUT_RE = re.compile(
+    r"\b(?:408|429|50[0234])[ \t]+(?-i:[A-Z])|too many requests|bad gateway"
+    r"|service unavailable|gateway time-?out|connection (?:refused|reset)"
+    r"|i/o timeout|timeout exceeded|unexpected EOF",
+    re.I,
+)
+
+
+def timed(method):
+    """
+    Accumulate wall-clock duration of method calls in timings of Runner.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        name = method.__name__
+        start = time.monotonic()
+        self.running_phases.append((name, start))
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.running_phases.pop()
+            duration = time.monotonic() - start
+            self.timings[name] = self.timings.get(name, 0) + duration
+
+    return wrapper
 
 
 class RunnerState(Enum):
     REREGISTERED = "Reregistered"
     REGISTERED = "Registered"
+    UPDATED = "Updated"
     UNREGISTERED = "Unregistered"
     TOKEN_MISMATCH = "Token Mismatch"
     NAME_MISMATCH = "Runner Name Mismatch"
 
 
+class GitlabApiError(Exception):
+    def __init__(
+        self,
+        msg: str,
+        status: int = None,
+        body: str = None,
+        retry_after: int = None,
+    ):
+        super(GitlabApiError, self).__init__(msg)
+        self.status = status
+        self.body = body
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        # No status means network error
+        return self.status is None or self.status in RETRYABLE_STATUSES
+
+
+class CommandError(Exception):
+    def __init__(self, rc: int, stdout: str, stderr: str):
+        super(CommandError, self).__init__(f"rc={rc}")
+        self.rc = rc
+        self.stdout = stdout
+        self.stderr = stderr
+        self.retry_after = None
+
+    @property
+    def retryable(self):
+        return bool(RETRYABLE_OUTPUT_RE.search(f"{self.stdout}\n{self.stderr}"))
+
+
+class GitlabApi(object):
+    """
+    Minimal client of Gitlab Runner API.
+    Connection is kept alive and reused by all requests of module run.
+    """
+
+    def __init__(self, api_url: str, validate_certs: bool = True):
+        url = urlsplit(api_url)
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.base_path = url.path.rstrip("/")
+        self.validate_certs = validate_certs
+        self.conn = None
+        self.requests = 0
+
+    def get_connection(self):
+        if self.conn is None:
+            if self.scheme == "https":
+                context = ssl.create_default_context()
+                if not self.validate_certs:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                self.conn = http.client.HTTPSConnection(
+                    self.host,
+                    self.port,
+                    timeout=API_TIMEOUT,
+                    context=context,
+                )
+            else:
+                self.conn = http.client.HTTPConnection(
+                    self.host,
+                    self.port,
+                    timeout=API_TIMEOUT,
+                )
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        payload: dict = None,
+        private_token: str = None,
+    ):
+        """
+        Send JSON request and return decoded JSON response.
+        """
+        url = self.base_path + path
+        body = None if payload is None else json.dumps(payload)
+        headers = {
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        }
+        if private_token:
+            headers["PRIVATE-TOKEN"] = private_token
+        self.requests += 1
+        for attempt in range(2):
+            conn = self.get_connection()
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (ConnectionResetError, BrokenPipeError) as e:
+                # Server could close kept alive connection, reconnect once
+                self.close()
+                if attempt:
+                    raise GitlabApiError(f"{method} {url}: {e}")
+            except (OSError, http.client.HTTPException) as e:
+                self.close()
+                raise GitlabApiError(f"{method} {url}: {e}")
+
+        if response.status >= 400:
+            raise GitlabApiError(
+                f"{method} {url}: HTTP {response.status} {response.reason}",
+                status=response.status,
+                body=to_text(data),
+                retry_after=parse_retry_after(response.getheader("Retry-After")),
+            )
+        if not data:
+            return {}
+        try:
+            return json.loads(data)
+        except ValueError:
+            raise GitlabApiError(
+                f"{method} {url}: invalid JSON response",
+                status=response.status,
+                body=to_text(data),
+            )
+
+    def verify_runner(self, token: str, system_id: str):
+        """
+        Verify authentication token. Runner with given system ID
+        is created at Gitlab side on first verification.
+        """
+        payload = {"token": token, "system_id": system_id}
+        return self.request("POST", "/api/v4/runners/verify", payload)
+
+    def delete_runner(self, token: str, system_id: str):
+        """
+        Unregister runner. For authentication token only runner manager
+        of given system ID is removed as binary does. Runner itself and
+        its token are kept at Gitlab side.
+        """
+        if token.startswith(RUNNER_AUTH_TOKEN_PREFIX):
+            payload = {"token": token, "system_id": system_id}
+            return self.request("DELETE", "/api/v4/runners/managers", payload)
+        return self.request("DELETE", "/api/v4/runners", {"token": token})
+
+    def pause_runner(self, runner_id: int, private_token: str, paused: bool = True):
+        """
+        Pause or unpause runner. Access token allowed to manage runner
+        is required, runner token can't do that.
+        """
+        return self.request(
+            "PUT",
+            f"/api/v4/runners/{runner_id}",
+            {"paused": paused},
+            private_token=private_token,
+        )
+
+
+class RunnerAction(Enum):
+    NOOP = "noop"
+    REGISTER = "register"
+    REREGISTER = "reregister"
+    UPDATE = "update"
+    UNREGISTER = "unregister"
+
+
+# State of runner after action is done
+ACTION_STATES = {
+    RunnerAction.REGISTER: RunnerState.REGISTERED,
+    RunnerAction.REREGISTER: RunnerState.REREGISTERED,
+    RunnerAction.UPDATE: RunnerState.UPDATED,
+    RunnerAction.UNREGISTER: RunnerState.UNREGISTERED,
+}
+
+
 class Runner(object):
-    def __init__(self, module: AnsibleModule):
+    def __init__(self, module: AnsibleModule, profiler: cProfile.Profile = None):
         self.module = module
+        self.profiler = profiler
+        self.profile_dir = os.environ.get(PROFILE_ENV)
+        if self.module.params["profile_dir"]:
+            self.profile_dir = self.module.params["profile_dir"]
+        if self.profile_dir and self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
 
-        self.state = self.module.params["state"]
         self.api_url = self.module.params["api_url"]
-        self.token = self.module.params["token"]
-        self.name = self.module.params["name"]
-        self.executor = self.module.params.get("executor")
-        self.default_image = self.module.params["default_image"]
-        self.environ_vars = self.module.params.get("environ_vars")
-        self.global_params = self.module.params.get("global_params")
-        self.template_file = self.module.params.get("template_file")
-        self.recreate = self.module.params.get("recreate")
+        self.global_params = drop_none(self.module.params.get("global_params"))
+        self.global_params_mode = self.module.params["global_params_mode"]
+        self.update_in_place = self.module.params["update_in_place"]
+        self.skip_unchanged = self.module.params["skip_unchanged"]
+        self.service_probe = self.module.params["service_probe"]
+        self.backend = self.module.params["backend"]
         self.warnings = []
-        self.current_name = None
+        self.config = {}
+        # Runner sections of config indexed by name and token hash
+        self.sections_by_name = {}
+        self.sections_by_token = {}
+        # Set when binary changed config file behind loaded content
+        self.config_stale = False
+        # Set when loaded content has changes not written to config file
+        self.config_dirty = False
+        # Set when only runner identities are loaded by scanner
+        self.config_partial = False
+        self.pending_updates = []
+        # Runner keys applied by last run, loaded on first use
+        self.applied = None
+        self.applied_data = None
+        self.api = None
+        self.verify_token = self.module.params["verify_token"]
+        self.token_cache_ttl = self.module.params["token_cache_ttl"]
+        self.token_cache = None
+        self.retries = self.module.params["retries"]
+        self.retry_delay = self.module.params["retry_delay"]
+        self.retry_max_delay = self.module.params["retry_max_delay"]
+        self.retry_attempts = 0
+        self.backoff_time = 0.0
+        self.system_id_timeout = self.module.params["system_id_timeout"]
+        self.make_before_break = self.module.params["make_before_break"]
+        self.rollback_on_failure = self.module.params["rollback_on_failure"]
+        # Planned actions of run, set once config is about to change
+        self.journal = None
+        self.drain_timeout = self.module.params["drain_timeout"]
+        self.drain_pause = self.module.params["drain_pause"]
+        self.api_token = self.module.params["api_token"]
+        self.reload = self.module.params["reload_service"]
+        self.reload_timeout = self.module.params["reload_timeout"]
+        self.metrics_url = self.module.params["metrics_url"]
+        # Set when config file was changed by module or binary
+        self.config_changed = False
+        self.lock_timeout = self.module.params["lock_timeout"]
+        self.lock_fd = None
+        self.lock_wait = 0.0
 
         self.command_results = {}
+        # Wall-clock duration of module phases
+        self.timings = {}
+        # Phases in progress with their start, reported if module fails
+        self.running_phases = []
+        self.commands_run = 0
 
-        self.bin = self.get_binary()
+        self.specs = self.get_runner_specs()
+        self.bin = None
+
+    def get_runner_specs(self):
+        """
+        Build list of desired runners.
+        Top-level options are defaults for every item of runners option.
+        """
+        params = self.module.params
+        items = params.get("runners")
+        if items is None:
+            items = [{"name": params["name"], "token": params["token"]}]
+        elif not items:
+            self.module.fail_json(msg="runners can't be empty.")
 
+        specs = []
+        for item in items:
+            spec = {
+                "name": item["name"],
+                "token": item["token"],
+                "current_name": None,
+            }
+            for key in RUNNER_DEFAULT_OPTIONS:
+                value = item.get(key)
+                spec[key] = params.get(key) if value is None else value
+
+            if not any(spec[key] for key in RUNNER_CONFIG_OPTIONS):
+                self.module.fail_json(
+                    msg="one of the following is required: %s (runner %s)"
+                    % (", ".join(RUNNER_CONFIG_OPTIONS), spec["name"]),
+                )
+            reserved = set(spec["runner_params"] or {}) & set(RUNNER_IDENTITY_KEYS)
+            if reserved:
+                self.module.fail_json(
+                    msg="runner_params can't set %s (runner %s)"
+                    % (", ".join(sorted(reserved)), spec["name"]),
+                )
+            specs.append(spec)
+
+        names = [spec["name"] for spec in specs]
+        if len(names) != len(set(names)):
+            self.module.fail_json(msg="Runner names must be unique.")
+
+        if "runners" in (self.global_params or {}):
+            self.module.fail_json(msg="global_params can't hold runners.")
+
+        # Checked before anything is changed, drain happens mid-run
+        if self.drain_timeout and not self.metrics_url:
+            self.module.fail_json(msg="metrics_url is required by drain_timeout.")
+        if self.drain_timeout and self.drain_pause == "api" and not self.api_token:
+            self.module.fail_json(msg="api_token is required by drain_pause api.")
+
+        return specs
+
+    @timed
     def load_config_content(self):
         """
         Get current Gitlab Runner configuration content.
         Return data as Dict.
         """
-        return toml.load(RUNNER_CONFIG)
+        return self.read_toml(RUNNER_CONFIG)
+
+    @timed
+    def load_config_identities(self):
+        """
+        Get name and token of every runner section without parsing
+        whole config. Whole config is parsed only if scanner can't
+        handle it or content is needed for edit.
+        """
+        sections = scan_runner_sections(RUNNER_CONFIG)
+        if sections is None:
+            return self.load_config_content()
+        self.config_partial = True
+        return {"runners": sections}
+
+    def get_toml_lib(self, kind: str):
+        """
+        Get TOML lib to read or write config.
+        """
+        names = TOML_READERS if kind == "read" else TOML_WRITERS
+        name, lib = import_toml_lib(names)
+        if lib is None:
+            self.fail(msg=missing_required_lib("toml"))
+        self.command_results.setdefault("toml_backend", {})[kind] = name
+        return lib
 
+    def read_toml(self, path: str):
+        lib = self.get_toml_lib("read")
+        with open(path, encoding="utf-8") as f:
+            return lib.loads(f.read())
+
+    @timed
     def make_start_config(self):
         """
         Global variables can't be managed with binary by ENVs or template file.
         Before registering instance global variables modified here.
+        Config is left untouched if it holds any other runner.
+        In merge mode globals are handled by merge_global_params.
         """
-        if self.global_params:
-            tmpfd, tmpfile = tempfile.mkstemp(dir=self.module.tmpdir)
-            with os.fdopen(tmpfd, "w") as f:
-                toml.dump(self.global_params, f)
-            self.module.atomic_move(tmpfile, RUNNER_CONFIG)
+        if self.global_params_mode == "merge":
+            return
+        start_globals = self.get_start_globals()
+        if start_globals and not self.config.get("runners"):
+            self.dump_config(start_globals)
+            self.set_config(copy.deepcopy(start_globals))
+            self.config_stale = False
+            self.config_partial = False
+            self.config_dirty = False
 
-    def verify_config_exists(self):
+    def get_start_globals(self):
         """
-        Assumed that base config file and runner_id file are
-        already added by gitlab-runner service itself.
+        Globals written before registration in replace mode.
         """
-        try:
-            os.stat(RUNNER_ID)
-        except FileNotFoundError:
-            # We assume that gitlab-runner after start creates config
-            self.module.fail_json(
-                msg="Runner didn't initialize it's runner_id.",
-            )
+        if self.global_params is None:
+            return get_default_globals()
+        return self.global_params
 
-        try:
-            os.stat(RUNNER_CONFIG)
-        except FileNotFoundError:
+    def merge_global_params(self):
+        """
+        Merge global params into top-level keys and tables of config.
+        Runner sections are kept. Nothing is written if all params
+        already have desired values.
+        """
+        if not self.global_params:
             return False
-
+        self.refresh_config()
+        if is_subset(self.global_params, self.config):
+            return False
+        merge_dict(self.config, copy.deepcopy(self.global_params))
+        self.config_dirty = True
         return True
 
-    def get_state(self, config: dict):
+    @timed
+    def dump_config(self, content: dict):
         """
-        Simple mapping of different gitlab-runner states
+        Atomically replace config file with given content.
         """
-        try:
-            runner_section = config["runners"][0]
-            runner_name = runner_section["name"]
-            runner_token = runner_section["token"]
-        except (IndexError, KeyError):
-            return RunnerState.UNREGISTERED
-        if runner_token != self.token:
-            return RunnerState.TOKEN_MISMATCH
-        if runner_name != self.name:
-            miss_state = RunnerState.NAME_MISMATCH.value
-            self.warnings.append(
-                f"{miss_state}. Perhaps re-registration required.",
-            )
-            self.current_name = runner_name
+        data = self.dump_toml(content)
+        self.write_file(RUNNER_CONFIG, data.encode("utf-8"))
+        self.config_changed = True
 
-        return RunnerState.REGISTERED
-
-    def register_runner(self):
+    def dump_toml(self, content: dict):
         """
-        Register Gitlab Runner. It runs binary in non-interactive mode.
-        If template file provided then add template path to command
-        in addition to cli parameters.
+        Serialize content as TOML. TOML has no null, so None values are
+        dropped as toml lib always did. Writers differ on other values
+        they can't serialize, module fails cleanly on those.
         """
-        cmd = [self.bin, "register", "--non-interactive"]
-        cmd.extend(["--url", self.api_url])
-        cmd.extend(["--token", self.token])
-        cmd.extend(["--name", self.name])
-        if self.executor:
-            cmd.extend(["--executor", self.executor])
-        if self.default_image:
-            cmd.extend(["--docker-image", self.default_image])
-        if self.template_file:
-            cmd.extend(["--template-config", self.template_file])
-
-        # Prepare environment variables
-        environment = None
-        if self.environ_vars:
-            environment = {}
-            for k, v in self.environ_vars.items():
-                environment[k] = to_text(v)
+        try:
+            return self.get_toml_lib("write").dumps(drop_none(content))
+        except (TypeError, ValueError) as e:
+            self.fail(msg=f"Can't serialize config.toml content: {e}")
 
-        rc, stdout, stderr = self.module.run_command(
-            cmd,
-            environ_update=environment,
-        )
-        if rc != 0:
-            self.module.fail_json(
-                msg="Error while registering runner",
-                stdout=stdout,
-                stderr=stderr,
-            )
+    def write_file(self, path: str, data: bytes):
+        """
+        Atomically replace file with given content.
+        """
+        tmpfd, tmpfile = tempfile.mkstemp(dir=self.module.tmpdir)
+        with os.fdopen(tmpfd, "wb") as f:
+            f.write(data)
+        self.module.atomic_move(tmpfile, path)
 
-    def unregister_runner(self):
+    def refresh_config(self):
         """
-        Unregister Gitlab Runner instance.
+        Reload config content if binary changed config file
+        or only runner identities are loaded.
         """
-        cmd = [self.bin, "unregister"]
-        name = self.name
-        if self.current_name:
-            name = self.current_name
-        cmd.extend(["--name", name])
-        rc, stdout, stderr = self.module.run_command(cmd)
-        if rc != 0:
-            self.module.fail_json(
-                msg="Error while unregistering runner",
-                stdout=stdout,
-                stderr=stderr,
-            )
+        if self.config_stale or self.config_partial:
+            config = {}
+            if os.path.exists(RUNNER_CONFIG):
+                config = self.load_config_content()
+            self.set_config(config)
+            self.config_stale = False
+            self.config_partial = False
 
-    def get_binary(self):
+    def flush_config(self):
         """
-        Get binary path of gitlab-runner.
+        Write changes of loaded config content to config file.
         """
-        return self.module.get_bin_path("gitlab-runner", required=True)
+        if self.config_dirty:
+            # Not retried by fail() if content can't be written
+            self.config_dirty = False
+            self.dump_config(self.config)
 
-    def check_service(self):
+    def make_runner_section(self, spec: dict):
         """
-        Verify that gitlab-runner service is running
+        Build desired keys of runner section.
+        Only those keys are managed by in place update. Precedence is
+        the same as on registration: template, ENVs, module options.
         """
-        cmd = [self.bin, "status"]
-        rc, stdout, stderr = self.module.run_command(cmd)
-        if rc != 0:
-            if re.search(r"Service has stopped", stderr, re.MULTILINE):
-                self.module.fail_json(msg="Service(systemd) not running.")
-            else:
-                self.module.fail_json(
-                    "gitlab-runner can't get status",
-                    stdout=stdout,
-                    stderr=stderr,
-                )
+        section = {}
+        for key, value in self.load_template(spec).items():
+            if key not in RUNNER_IDENTITY_KEYS:
+                section[key] = copy.deepcopy(value)
+        merge_dict(section, make_env_section(spec["environ_vars"])[0])
+        if spec["executor"]:
+            section["executor"] = spec["executor"]
+        if spec["default_image"]:
+            docker = section.get("docker")
+            if not isinstance(docker, dict):
+                docker = section["docker"] = {}
+            docker["image"] = spec["default_image"]
+        if spec["runner_params"]:
+            merge_dict(section, copy.deepcopy(spec["runner_params"]))
+        # Key set to null isn't desired, it isn't written to config anyway
+        return drop_none(section)
 
-        if not re.search("Service is running", stdout, re.MULTILINE):
-            self.module.fail_json(
-                msg="Gitlab-Runner service not running! Ensure service is up.",
-                stdout=stdout,
-                stderr=stderr,
-            )
+    def load_applied(self):
+        """
+        Get runner keys applied by last run.
+        """
+        if self.applied is None:
+            self.applied = {}
+            try:
+                with open(RUNNER_APPLIED) as f:
+                    self.applied_data = f.read()
+                data = json.loads(self.applied_data)
+                if data.get("version") == RUNNER_APPLIED_VERSION:
+                    self.applied = data["runners"]
+            except (OSError, ValueError, KeyError):
+                pass
+        return self.applied
 
-    def do_disable(self):
-        "Unregister Gitlab Runner."
-        self.unregister_runner()
+    def get_applied(self, spec: dict):
+        return self.load_applied().get(spec["name"], {}).get("section", {})
 
-    def do_enable(self):
+    def save_applied(self, results: list):
         """
-        Create basic minimal config file with global variables.
-        Run registration of Gitlab Runner.
+        Store desired keys of registered runners for next three-way merge.
+        ENVs which aren't applied in place are stored to detect changes.
         """
-        self.make_start_config()
-        self.register_runner()
+        applied = self.load_applied()
+        for spec, result in zip(self.specs, results):
+            if result["runner_state"] == RunnerState.UNREGISTERED.value:
+                applied.pop(spec["name"], None)
+                continue
+            applied[spec["name"]] = {
+                "section": self.make_runner_section(spec),
+                "environ_vars": make_env_section(spec["environ_vars"])[1],
+            }
+        data = json.dumps(
+            {"version": RUNNER_APPLIED_VERSION, "runners": applied},
+            sort_keys=True,
+            default=str,
+        )
+        if data != self.applied_data:
+            self.write_file(RUNNER_APPLIED, data.encode())
+            self.applied_data = data
 
-    def do_reenable(self):
+    def merge_section(self, section: dict, spec: dict):
         """
-        Recreate Gitlab Runner instance.
-        It creates basic minimal config file and
-        run registration of Gitlab Runner.
+        Three-way merge of desired keys into runner section.
         """
-        self.unregister_runner()
-        self.do_enable()
+        three_way_merge(section, self.make_runner_section(spec), self.get_applied(spec))
+        return section
 
-    def act(self):
+    def check_unapplied_envs(self, spec: dict):
         """
-        Main logic entrypoint.
+        Warn about changed ENVs which in place update can't apply.
         """
-        state_after = None
-        self.check_service()
-
-        config_exists = self.verify_config_exists()
-
-        if config_exists:
-            config_content = self.load_config_content()
-            state_before = self.get_state(config_content)
-        else:
-            state_before = RunnerState.UNREGISTERED
+        saved = self.load_applied().get(spec["name"], {}).get("environ_vars")
+        unknown = make_env_section(spec["environ_vars"])[1]
+        changed = sorted(
+            name
+            for name in set(unknown) | set(saved or {})
+            if unknown.get(name) != (saved or {}).get(name)
+        )
+        if saved is not None and changed:
+            self.warnings.append(
+                f"{spec['name']}: environ_vars {', '.join(changed)} can't be "
+                "applied in place. Use recreate to apply them.",
+            )
 
-        if self.state == "present":
-            if state_before == RunnerState.UNREGISTERED:
-                self.do_enable()
-                state_after = RunnerState.REGISTERED
-                self.command_results["msg"] = "Init registering Runner"
+    def update_runner_sections(self):
+        """
+        Apply desired keys to runner sections queued for update.
+        Config is written once for all of them. Token and system ID
+        of runner are kept as is.
+        """
+        if not self.pending_updates:
+            return
 
-            elif state_before == RunnerState.TOKEN_MISMATCH:
-                self.do_reenable()
-                state_after = RunnerState.REREGISTERED
-                self.command_results["msg"] = (
-                    "Reregistering Runner due to Token mismatch"
+        self.refresh_config()
+        for spec in self.pending_updates:
+            section = self.find_section(spec)
+            if section is None:
+                self.warnings.append(
+                    f"{spec['name']}: runner section not found, not updated.",
                 )
+                continue
+            self.merge_section(section, spec)
 
-            elif state_before == RunnerState.REGISTERED:
-                if self.recreate:
-                    self.do_reenable()
-                    state_after = RunnerState.REREGISTERED
-                    self.command_results["msg"] = (
-                        "Force reregistering Runner due to recreate option"
-                    )
+        self.config_dirty = True
+        self.pending_updates = []
 
-        elif self.state == "absent":
-            if state_before == RunnerState.REGISTERED:
-                self.do_disable()
-                state_after = RunnerState.UNREGISTERED
-                self.command_results["msg"] = "Unregistering Runner"
+    def section_differs(self, spec: dict):
+        """
+        Check whether managed keys of registered runner differ from desired.
+        """
+        self.refresh_config()
+        section = self.find_section(spec) or {}
+        return self.merge_section(copy.deepcopy(section), spec) != section
+
+    @timed
+    def wait_system_id(self):
+        """
+        Wait for gitlab-runner service to create system ID file.
+        Service creates it shortly after its first start.
+        """
+        if file_ready(RUNNER_ID):
+            return
+        start = time.monotonic()
+        backend = wait_for_file(RUNNER_ID, self.system_id_timeout)
+        self.command_results["system_id_wait"] = {
+            "backend": backend,
+            "duration": round(time.monotonic() - start, 6),
+        }
+        if not file_ready(RUNNER_ID):
+            self.fail(
+                msg="Runner didn't initialize it's runner_id "
+                f"in {self.system_id_timeout:g} seconds.",
+                system_id_wait=self.command_results["system_id_wait"],
+            )
+
+    @timed
+    def verify_config_exists(self):
+        """
+        Assumed that base config file and runner_id file are
+        already added by gitlab-runner service itself.
+        """
+        if not file_ready(RUNNER_ID):
+            # We assume that gitlab-runner after start creates config
+            self.fail(msg="Runner didn't initialize it's runner_id.")
+
+        try:
+            os.stat(RUNNER_CONFIG)
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    def get_config_stat(self):
+        """
+        Identity of config file content as seen by filesystem.
+        """
+        try:
+            st = os.stat(RUNNER_CONFIG)
+        except FileNotFoundError:
+            return None
+        return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+    def get_inputs_hash(self):
+        """
+        Hash of resolved module inputs. Token itself is never stored,
+        template file is hashed by its content.
+        """
+        runners = []
+        for spec in self.specs:
+            template = None
+            if spec["template_file"]:
+                try:
+                    with open(spec["template_file"], "rb") as f:
+                        template = hashlib.sha256(f.read()).hexdigest()
+                except OSError:
+                    pass
+            runners.append(
+                {
+                    "name": spec["name"],
+                    "token": hash_token(spec["token"]),
+                    "state": spec["state"],
+                    "executor": spec["executor"],
+                    "default_image": spec["default_image"],
+                    "environ_vars": spec["environ_vars"],
+                    "runner_params": spec["runner_params"],
+                    "template_file": template,
+                },
+            )
+        inputs = {
+            "version": RUNNER_STATE_VERSION,
+            "api_url": self.api_url,
+            "global_params": self.global_params,
+            "global_params_mode": self.global_params_mode,
+            "update_in_place": self.update_in_place,
+            "runners": runners,
+        }
+        data = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def load_saved_state(self):
+        """
+        Get state stored by last successful run.
+        """
+        try:
+            with open(RUNNER_STATE) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_state(self, inputs_hash: str, results: list):
+        """
+        Store inputs hash and config file stat seen after apply.
+        Transitional states are stored as state of the next noop run.
+        """
+        transitional = (RunnerState.REREGISTERED.value, RunnerState.UPDATED.value)
+        runners = []
+        for result in results:
+            runner_state = result["runner_state"]
+            if runner_state in transitional:
+                runner_state = RunnerState.REGISTERED.value
+            runners.append({"name": result["name"], "runner_state": runner_state})
+
+        state = {
+            "inputs": inputs_hash,
+            "config": self.get_config_stat(),
+            "runners": runners,
+        }
+        self.write_file(RUNNER_STATE, json.dumps(state).encode())
+
+    def get_unchanged_results(self, inputs_hash: str):
+        """
+        Return results of last run if nothing changed since then.
+        """
+        saved = self.load_saved_state()
+        if not saved or saved.get("inputs") != inputs_hash:
+            return None
+        if saved.get("config") != self.get_config_stat():
+            return None
+        return [
+            {"name": r["name"], "runner_state": r["runner_state"], "changed": False}
+            for r in saved["runners"]
+        ]
+
+    def begin_journal(self, plans: list):
+        """
+        Save snapshot of config file and record planned actions
+        before config is changed first time.
+        """
+        snapshot = os.path.exists(RUNNER_CONFIG)
+        if snapshot:
+            with open(RUNNER_CONFIG, "rb") as f:
+                self.write_file(RUNNER_SNAPSHOT, f.read())
+        self.journal = {
+            "version": RUNNER_JOURNAL_VERSION,
+            "snapshot": snapshot,
+            "runners": [
+                {"name": spec["name"], "action": plan["action"].value, "done": False}
+                for spec, plan in zip(self.specs, plans)
+                if plan["action"] != RunnerAction.NOOP
+            ],
+        }
+        self.save_journal()
+
+    def save_journal(self):
+        self.write_file(RUNNER_JOURNAL, json.dumps(self.journal).encode())
+
+    def journal_done(self, spec: dict):
+        """
+        Record that action of runner is done.
+        """
+        for entry in self.journal["runners"]:
+            if entry["name"] == spec["name"] and not entry["done"]:
+                entry["done"] = True
+                self.save_journal()
+                return
+
+    def end_journal(self):
+        """
+        Drop journal and snapshot of run which finished.
+        """
+        self.journal = None
+        for path in (RUNNER_JOURNAL, RUNNER_SNAPSHOT):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def load_journal(self):
+        """
+        Get journal left by interrupted run.
+        """
+        try:
+            with open(RUNNER_JOURNAL) as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if journal.get("version") != RUNNER_JOURNAL_VERSION:
+            return None
+        return journal
+
+    def rollback(self):
+        """
+        Restore config file from snapshot taken before run.
+        """
+        if self.journal["snapshot"]:
+            with open(RUNNER_SNAPSHOT, "rb") as f:
+                self.write_file(RUNNER_CONFIG, f.read())
+        elif os.path.exists(RUNNER_CONFIG):
+            os.remove(RUNNER_CONFIG)
+        self.config_dirty = False
+        self.config_changed = True
+        self.end_journal()
+        if self.reload:
+            self.reload_service()
+        return True
+
+    def resume_journal(self, journal: dict):
+        """
+        Complete actions left by interrupted run. Runners are brought to
+        desired state by this run anyway, only intermediate replacement
+        runners of make-before-break need care.
+        """
+        left = [entry["name"] for entry in journal["runners"] if not entry["done"]]
+        self.command_results["resumed"] = left
+        if self.module.check_mode:
+            return
+
+        self.refresh_config()
+        for name in left:
+            replacement = self.sections_by_name.get(name + RUNNER_REPLACEMENT_SUFFIX)
+            if replacement is None:
+                continue
+            if name in self.sections_by_name:
+                # Old runner wasn't unregistered, replacement is dropped
+                self.remove_section(replacement)
+                self.config_dirty = True
+                self.warnings.append(
+                    f"{name}: replacement runner left by interrupted run "
+                    "is removed from config.",
+                )
+            else:
+                self.rename_section(replacement["name"], name)
+
+    def set_config(self, config: dict):
+        """
+        Use given config content and index its runner sections.
+        """
+        self.config = config
+        self.sections_by_name = {}
+        self.sections_by_token = {}
+        for section in config.get("runners", []):
+            self.index_section(section)
+
+    def index_section(self, section: dict):
+        # First section wins as gitlab-runner uses first match too
+        if "name" in section:
+            self.sections_by_name.setdefault(section["name"], section)
+        if "token" in section:
+            token_hash = hash_token(section["token"])
+            self.sections_by_token.setdefault(token_hash, section)
+
+    def add_section(self, section: dict):
+        self.config.setdefault("runners", []).append(section)
+        self.index_section(section)
+
+    def remove_section(self, section: dict):
+        self.config["runners"] = [
+            s for s in self.config.get("runners", []) if s is not section
+        ]
+        self.set_config(self.config)
+
+    def find_section(self, spec: dict):
+        """
+        Find runner section by name. Fallback to token lookup
+        to detect renamed runner.
+        """
+        section = self.sections_by_name.get(spec["name"])
+        if section is None:
+            section = self.sections_by_token.get(hash_token(spec["token"]))
+        return section
+
+    @timed
+    def get_state(self, spec: dict):
+        """
+        Simple mapping of different gitlab-runner states
+        """
+        try:
+            runner_section = self.find_section(spec)
+            runner_name = runner_section["name"]
+            runner_token = runner_section["token"]
+        except (TypeError, KeyError):
+            return RunnerState.UNREGISTERED
+        if runner_token != spec["token"]:
+            return RunnerState.TOKEN_MISMATCH
+        if runner_name != spec["name"]:
+            miss_state = RunnerState.NAME_MISMATCH.value
+            self.warnings.append(
+                f"{spec['name']}: {miss_state}. Perhaps re-registration required.",
+            )
+            spec["current_name"] = runner_name
+
+        return RunnerState.REGISTERED
+
+    @timed
+    def register_runner(self, spec: dict):
+        """
+        Register Gitlab Runner. It runs binary in non-interactive mode.
+        If template file provided then add template path to command
+        in addition to cli parameters.
+        """
+        if self.use_api(spec):
+            self.register_runner_api(spec)
+            return
+
+        cmd = [self.bin, "register", "--non-interactive"]
+        cmd.extend(["--url", self.api_url])
+        cmd.extend(["--token", spec["token"]])
+        cmd.extend(["--name", spec["name"]])
+        if spec["executor"]:
+            cmd.extend(["--executor", spec["executor"]])
+        if spec["default_image"]:
+            cmd.extend(["--docker-image", spec["default_image"]])
+        if spec["template_file"]:
+            cmd.extend(["--template-config", spec["template_file"]])
+
+        # Prepare environment variables
+        environment = None
+        if spec["environ_vars"]:
+            environment = {}
+            for k, v in spec["environ_vars"].items():
+                environment[k] = to_text(v)
+
+        self.flush_config()
+        try:
+            self.call_with_retries(
+                spec,
+                self.run_binary,
+                cmd,
+                environ_update=environment,
+            )
+        except CommandError as e:
+            self.fail(
+                msg="Error while registering runner",
+                stdout=e.stdout,
+                stderr=e.stderr,
+            )
+
+        self.config_stale = True
+        self.config_changed = True
+        self.add_section({"name": spec["name"], "token": spec["token"]})
+
+    @timed
+    def unregister_runner(self, spec: dict):
+        """
+        Unregister Gitlab Runner instance.
+        """
+        if self.use_api(spec):
+            self.unregister_runner_api(spec)
+            return
+
+        cmd = [self.bin, "unregister"]
+        name = spec["name"]
+        if spec["current_name"]:
+            name = spec["current_name"]
+        cmd.extend(["--name", name])
+        self.flush_config()
+        try:
+            self.call_with_retries(spec, self.run_binary, cmd)
+        except CommandError as e:
+            self.fail(
+                msg="Error while unregistering runner",
+                stdout=e.stdout,
+                stderr=e.stderr,
+            )
+
+        self.config_stale = True
+        self.config_changed = True
+        section = self.sections_by_name.get(name)
+        if section is not None:
+            self.remove_section(section)
+
+    def call_with_retries(self, spec: dict, func, *args, **kwargs):
+        """
+        Call func retrying transient errors with exponential backoff
+        and full jitter. Error of last attempt is raised.
+        """
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except (GitlabApiError, CommandError) as e:
+                if attempt >= self.retries or not e.retryable:
+                    raise
+                delay = self.get_backoff(attempt, e.retry_after)
+            attempt += 1
+            self.retry_attempts += 1
+            self.backoff_time += delay
+            spec["retry_attempts"] = spec.get("retry_attempts", 0) + 1
+            spec["backoff_time"] = spec.get("backoff_time", 0) + delay
+            time.sleep(delay)
+
+    def get_backoff(self, attempt: int, retry_after: int = None):
+        """
+        Delay before retry of given attempt. Retry-After of server wins
+        over random delay if it's longer, both are limited by max delay.
+        """
+        delay = random.uniform(0, self.retry_delay * 2**attempt)
+        if retry_after:
+            delay = max(delay, retry_after)
+        return min(delay, self.retry_max_delay)
+
+    def run_binary(self, cmd: list, **kwargs):
+        """
+        Run gitlab-runner command. Raise CommandError if it fails.
+        """
+        rc, stdout, stderr = self.run_command(cmd, **kwargs)
+        if rc != 0:
+            raise CommandError(rc, stdout, stderr)
+        return stdout
+
+    def use_api(self, spec: dict):
+        """
+        ENVs are understood by binary only.
+        """
+        return self.backend == "api" and not spec["environ_vars"]
+
+    def get_api(self):
+        if self.api is None:
+            self.api = GitlabApi(
+                self.api_url,
+                validate_certs=self.module.params["validate_certs"],
+            )
+        return self.api
+
+    def get_system_id(self):
+        """
+        System ID generated by gitlab-runner service.
+        """
+        with open(RUNNER_ID) as f:
+            return f.read().strip()
+
+    def load_template(self, spec: dict):
+        """
+        Get runner section of template file.
+        """
+        if not spec["template_file"]:
+            return {}
+        try:
+            template = self.read_toml(spec["template_file"])
+            return template.get("runners", [{}])[0]
+        except (OSError, IndexError, ValueError) as e:
+            self.fail(msg=f"Can't load template file: {e}")
+
+    def make_registered_section(self, spec: dict, data: dict):
+        """
+        Build runner section the same way 'gitlab-runner register' does.
+        Template is merged under module options.
+        """
+        section = {
+            "name": spec["name"],
+            "url": self.api_url,
+            "id": data["id"],
+            "token": data.get("token") or spec["token"],
+            "token_obtained_at": datetime.now(timezone.utc).replace(microsecond=0),
+            "token_expires_at": parse_api_time(data.get("token_expires_at")),
+        }
+        template = self.load_template(spec)
+        executor = spec["executor"] or template.get("executor")
+        if executor:
+            section["executor"] = executor
+        section["cache"] = {"MaxUploadedArchiveSize": 0}
+        if executor and executor.startswith("docker"):
+            section["docker"] = copy.deepcopy(RUNNER_DOCKER_DEFAULTS)
+
+        for key, value in template.items():
+            if key in RUNNER_IDENTITY_KEYS:
+                continue
+            if isinstance(value, dict) and isinstance(section.get(key), dict):
+                merge_dict(section[key], value)
+            else:
+                section[key] = value
+
+        if spec["default_image"]:
+            section.setdefault("docker", {})["image"] = spec["default_image"]
+        return section
+
+    def register_runner_api(self, spec: dict):
+        """
+        Register Gitlab Runner with API and add its section to config.
+        """
+        try:
+            data = self.call_with_retries(
+                spec,
+                self.get_api().verify_runner,
+                spec["token"],
+                self.get_system_id(),
+            )
+        except GitlabApiError as e:
+            self.fail(
+                msg=f"Error while registering runner: {e}",
+                status=e.status,
+                body=e.body,
+            )
+
+        self.refresh_config()
+        self.add_section(self.make_registered_section(spec, data))
+        self.config_dirty = True
+
+    def unregister_runner_api(self, spec: dict):
+        """
+        Unregister Gitlab Runner with API and drop its section from config.
+        Token of registered section is used as binary does.
+        """
+        self.refresh_config()
+        section = self.find_section(spec) or {}
+        try:
+            self.call_with_retries(
+                spec,
+                self.get_api().delete_runner,
+                section.get("token", spec["token"]),
+                self.get_system_id(),
+            )
+        except GitlabApiError as e:
+            self.fail(
+                msg=f"Error while unregistering runner: {e}",
+                status=e.status,
+                body=e.body,
+            )
+
+        self.remove_section(section)
+        self.config_dirty = True
+
+    def load_token_cache(self):
+        """
+        Get cached token verification results. Expired ones are dropped.
+        """
+        if self.token_cache is None:
+            self.token_cache = {}
+            try:
+                with open(RUNNER_TOKEN_CACHE) as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {}
+            now = time.time()
+            for key, entry in cache.items():
+                if now - entry.get("checked_at", 0) < self.token_cache_ttl:
+                    self.token_cache[key] = entry
+        return self.token_cache
+
+    def save_token_cache(self):
+        if self.token_cache is None or not self.token_cache_ttl:
+            return
+        self.write_file(RUNNER_TOKEN_CACHE, json.dumps(self.token_cache).encode())
+
+    def check_token(self, spec: dict):
+        """
+        Pre-flight check of token before destructive step.
+        Only definitive answers of API are cached.
+        """
+        key = hash_token(spec["token"])
+        cache = self.load_token_cache()
+        entry = cache.get(key)
+        spec["token_check"] = "cache"
+        if entry is None:
+            spec["token_check"] = "api"
+            try:
+                self.get_api().verify_runner(spec["token"], self.get_system_id())
+                entry = {"valid": True}
+            except GitlabApiError as e:
+                if e.status not in (401, 403):
+                    self.fail(
+                        msg=f"Can't verify token of runner {spec['name']}: {e}",
+                    )
+                entry = {"valid": False}
+            entry["checked_at"] = time.time()
+            cache[key] = entry
+
+        if not entry["valid"]:
+            self.fail(
+                msg=f"Token of runner {spec['name']} is invalid or revoked. "
+                "No runner is changed.",
+            )
+
+    def fail(self, **kwargs):
+        """
+        Keep changes done so far and fail. Config file is restored
+        from snapshot instead if rollback is requested.
+        """
+        if self.journal is not None and self.rollback_on_failure:
+            kwargs["rolled_back"] = self.rollback()
+        else:
+            self.flush_config()
+        self.save_token_cache()
+        kwargs.update(self.get_stats())
+        self.module.fail_json(**kwargs)
+
+    def get_stats(self):
+        """
+        Timings of module phases and count of external calls.
+        """
+        timings = dict(self.timings)
+        now = time.monotonic()
+        for name, start in self.running_phases:
+            timings[name] = timings.get(name, 0) + now - start
+        stats = {
+            "timings": {k: round(v, 6) for k, v in timings.items()},
+            "commands_run": self.commands_run,
+            "api_requests": self.api.requests if self.api else 0,
+            "retry_attempts": self.retry_attempts,
+            "backoff_time": round(self.backoff_time, 6),
+            "lock_wait": round(self.lock_wait, 6),
+        }
+        if self.profiler is not None:
+            stats["profile"] = self.save_profile()
+        return stats
+
+    def save_profile(self):
+        """
+        Stop profiler and write its stats to profile dir.
+        """
+        self.profiler.disable()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(
+            self.profile_dir,
+            f"gitlab_runner_register.{int(time.time())}.{os.getpid()}.prof",
+        )
+        self.profiler.dump_stats(path)
+        self.profiler = None
+
+        stats = pstats.Stats(path).sort_stats("cumulative")
+        top = []
+        for func in stats.fcn_list[: self.module.params["profile_top"]]:
+            calls, ncalls, tottime, cumtime, callers = stats.stats[func]
+            top.append(
+                {
+                    "function": "%s:%d(%s)" % func,
+                    "ncalls": ncalls,
+                    "tottime": round(tottime, 6),
+                    "cumtime": round(cumtime, 6),
+                },
+            )
+        return {"path": path, "top": top}
+
+    def acquire_lock(self):
+        """
+        Take exclusive lock of host so config is read, decided on and
+        written by one module run at a time. Lock is held until exit.
+        """
+        try:
+            fd = os.open(RUNNER_LOCK, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError as e:
+            self.fail(msg=f"Can't open lock file {RUNNER_LOCK}: {e}")
+
+        start = time.monotonic()
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                waited = time.monotonic() - start
+                if waited >= self.lock_timeout:
+                    os.close(fd)
+                    self.lock_wait = waited
+                    self.fail(
+                        msg="Timeout while waiting for lock of other module run "
+                        f"({RUNNER_LOCK}).",
+                    )
+                time.sleep(min(LOCK_POLL_INTERVAL, self.lock_timeout - waited))
+        self.lock_fd = fd
+        self.lock_wait = time.monotonic() - start
+
+    def release_lock(self):
+        if self.lock_fd is not None:
+            # Closing descriptor releases flock
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+    def run_command(self, cmd: list, **kwargs):
+        """
+        Run external command. Count of commands is reported.
+        """
+        self.commands_run += 1
+        return self.module.run_command(cmd, **kwargs)
+
+    @timed
+    def get_binary(self):
+        """
+        Get binary path of gitlab-runner.
+        """
+        return self.module.get_bin_path("gitlab-runner", required=True)
+
+    @timed
+    def check_service(self):
+        """
+        Verify that gitlab-runner service is running.
+        Service process is looked up directly first, binary is the fallback.
+        """
+        start = time.monotonic()
+        backend, pid = None, None
+        if self.service_probe == "auto" or self.module.check_mode:
+            backend, pid = find_service_pid()
+        if backend is None and self.module.check_mode:
+            # No commands are run in check mode
+            self.warnings.append(
+                "Gitlab-Runner service process not found. "
+                "Ensure service is up.",
+            )
+        elif backend is None:
+            backend = "status"
+            self.check_service_status()
+
+        self.command_results["service_probe"] = {
+            "backend": backend,
+            "pid": pid,
+            "duration": round(time.monotonic() - start, 6),
+        }
+
+    def check_service_status(self):
+        """
+        Verify that gitlab-runner service is running with binary.
+        """
+        cmd = [self.bin, "status"]
+        rc, stdout, stderr = self.run_command(cmd)
+        if rc != 0:
+            if re.search(r"Service has stopped", stderr, re.MULTILINE):
+                self.fail(msg="Service(systemd) not running.")
+            else:
+                self.fail(
+                    msg="gitlab-runner can't get status",
+                    stdout=stdout,
+                    stderr=stderr,
+                )
+
+        if not re.search("Service is running", stdout, re.MULTILINE):
+            self.fail(
+                msg="Gitlab-Runner service not running! Ensure service is up.",
+                stdout=stdout,
+                stderr=stderr,
+            )
+
+    @timed
+    def reload_service(self):
+        """
+        Make service load changed config at once with SIGHUP.
+        Reload is confirmed by configuration loaded counter of service metrics.
+        """
+        backend, pid = find_service_pid()
+        if pid is None:
+            self.warnings.append(
+                "Gitlab-Runner service process not found, config isn't reloaded.",
+            )
+            return
+
+        loaded = None
+        if self.metrics_url:
+            loaded = read_metric(self.metrics_url, RUNNER_RELOAD_METRIC)
+        start = time.monotonic()
+        try:
+            os.kill(pid, signal.SIGHUP)
+        except OSError as e:
+            self.warnings.append(f"Can't reload Gitlab-Runner service: {e}")
+            return
+
+        confirmed = None
+        if loaded is not None:
+            confirmed = self.wait_reload(pid, loaded)
+            if not confirmed:
+                self.warnings.append(
+                    "Gitlab-Runner service didn't confirm config reload "
+                    f"in {self.reload_timeout:g} seconds.",
+                )
+        self.command_results["service_reload"] = {
+            "pid": pid,
+            "confirmed": confirmed,
+            "duration": round(time.monotonic() - start, 6),
+        }
+
+    def wait_reload(self, pid: int, loaded: float):
+        """
+        Wait until configuration loaded counter grows over given value.
+        """
+        deadline = time.monotonic() + self.reload_timeout
+        while time.monotonic() < deadline:
+            if not is_service_process(pid):
+                return False
+            current = read_metric(self.metrics_url, RUNNER_RELOAD_METRIC)
+            if current is not None and current > loaded:
+                return True
+            time.sleep(METRICS_POLL_INTERVAL)
+        return False
+
+    def do_disable(self, spec: dict):
+        "Unregister Gitlab Runner."
+        self.unregister_drained(spec)
+
+    def unregister_drained(self, spec: dict):
+        """
+        Unregister Gitlab Runner after its running jobs finished.
+        """
+        if not self.drain_timeout:
+            self.unregister_runner(spec)
+            return
+
+        section = self.drain_runner(spec)
+        if section is not None:
+            # Binary can't unregister runner which isn't in config file, so
+            # section taken out by config pause is written back right before
+            # binary drops it again. API backend drops it from loaded content
+            # only, config file doesn't get it back.
+            self.add_section(section)
+            self.config_dirty = True
+        self.unregister_runner(spec)
+
+    @timed
+    def drain_runner(self, spec: dict):
+        """
+        Pause runner and wait until service has no running jobs.
+        Return runner section taken out of config file by config pause.
+        """
+        self.refresh_config()
+        section = self.find_section(spec)
+        if section is None:
+            return None
+
+        start = time.monotonic()
+        removed = None
+        paused_id = None
+        if self.drain_pause == "api":
+            self.pause_runner(spec, section, True)
+            paused_id = section["id"]
+        else:
+            self.remove_section(section)
+            self.config_dirty = True
+            self.flush_config()
+            self.reload_service()
+            removed = section
+
+        jobs = self.wait_drained(section.get("token", spec["token"]))
+        spec["drain"] = {
+            "pause": self.drain_pause,
+            "duration": round(time.monotonic() - start, 6),
+            "jobs_left": None if jobs is None else int(jobs),
+        }
+        if paused_id is not None:
+            spec["drain"]["runner_id"] = paused_id
+        if jobs:
+            self.warnings.append(
+                f"{spec['name']}: {int(jobs)} jobs are still running "
+                f"after {self.drain_timeout:g} seconds of drain.",
+            )
+        return removed
+
+    def pause_runner(self, spec: dict, section: dict, paused: bool):
+        """
+        Pause or unpause runner of given section with Gitlab API.
+        """
+        if "id" not in section:
+            self.fail(msg=f"Runner id is required to pause runner {spec['name']}.")
+        try:
+            self.call_with_retries(
+                spec,
+                self.get_api().pause_runner,
+                section["id"],
+                self.api_token,
+                paused,
+            )
+        except GitlabApiError as e:
+            action = "pause" if paused else "unpause"
+            self.fail(msg=f"Can't {action} runner {spec['name']}: {e}")
+
+    def wait_drained(self, token: str):
+        """
+        Wait until runner of given token has no running jobs or drain
+        timeout expires. Jobs of other runners of the service don't count.
+        Return count of running jobs left or None if it's unknown.
+        """
+        deadline = time.monotonic() + self.drain_timeout
+        while True:
+            jobs = read_metric(
+                self.metrics_url,
+                RUNNER_JOBS_METRIC,
+                lambda labels: is_runner_label(labels.get("runner"), token),
+            )
+            if jobs is None:
+                self.warnings.append(
+                    "Can't read metrics of Gitlab-Runner service, "
+                    "running jobs are unknown.",
+                )
+                return None
+            if jobs <= 0 or time.monotonic() >= deadline:
+                return jobs
+            time.sleep(min(DRAIN_POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+
+    def resume_runner(self, spec: dict):
+        """
+        Unpause runner paused by drain if it's registered again under
+        the same ID. Runner of new token was never paused by drain.
+        """
+        drain = spec.get("drain")
+        if not drain or drain.get("runner_id") is None:
+            return
+        self.refresh_config()
+        section = self.find_section(spec)
+        if section is not None and section.get("id") == drain["runner_id"]:
+            self.pause_runner(spec, section, False)
+
+    def do_enable(self, spec: dict):
+        """
+        Create basic minimal config file with global variables.
+        Run registration of Gitlab Runner.
+        """
+        self.make_start_config()
+        self.register_runner(spec)
+        if spec["runner_params"]:
+            self.pending_updates.append(spec)
 
-        if state_after:
-            self.command_results["runner_state"] = state_after.value
+    def do_reenable(self, spec: dict):
+        """
+        Recreate Gitlab Runner instance.
+        It creates basic minimal config file and
+        run registration of Gitlab Runner.
+        """
+        if self.make_before_break:
+            self.do_replace(spec)
+            return
+        self.unregister_drained(spec)
+        self.do_enable(spec)
+        self.resume_runner(spec)
+
+    def do_replace(self, spec: dict):
+        """
+        Register replacement runner under temporary name, then unregister
+        old runner and give its name to replacement.
+        """
+        self.refresh_config()
+        old = self.find_section(spec)
+        old_spec = make_sub_spec(spec, name=old["name"], token=old["token"])
+        new_spec = make_sub_spec(spec, name=spec["name"] + RUNNER_REPLACEMENT_SUFFIX)
+
+        self.register_runner(new_spec)
+        self.confirm_runner(new_spec)
+        if old_spec["token"] == new_spec["token"]:
+            # Gitlab side runner manager is shared with replacement
+            self.refresh_config()
+            self.remove_section(self.sections_by_name[old_spec["name"]])
+            self.config_dirty = True
         else:
-            self.command_results["runner_state"] = state_before.value
+            self.unregister_drained(old_spec)
+            if "drain" in old_spec:
+                spec["drain"] = old_spec["drain"]
+        self.rename_section(new_spec["name"], spec["name"])
+
+        for sub_spec in (new_spec, old_spec):
+            for key in ("retry_attempts", "backoff_time"):
+                spec[key] = spec.get(key, 0) + sub_spec[key]
+        if spec["runner_params"]:
+            self.pending_updates.append(spec)
+
+    def confirm_runner(self, spec: dict):
+        """
+        Check that replacement runner is registered and accepted by Gitlab.
+        Replacement is dropped from config otherwise.
+        """
+        self.refresh_config()
+        error = None
+        if spec["name"] not in self.sections_by_name:
+            error = "runner section not found"
+        elif not self.use_api(spec):
+            # API registration is verification itself
+            try:
+                self.call_with_retries(
+                    spec,
+                    self.get_api().verify_runner,
+                    spec["token"],
+                    self.get_system_id(),
+                )
+            except GitlabApiError as e:
+                error = str(e)
+
+        if error:
+            section = self.sections_by_name.get(spec["name"])
+            if section is not None:
+                self.remove_section(section)
+                self.config_dirty = True
+            self.fail(
+                msg=f"Replacement runner {spec['name']} isn't confirmed: {error}. "
+                "Old runner is left as is.",
+            )
+
+    def rename_section(self, name: str, new_name: str):
+        """
+        Rename runner section. Name is local to host, Gitlab isn't involved.
+        """
+        self.refresh_config()
+        self.sections_by_name[name]["name"] = new_name
+        self.set_config(self.config)
+        self.config_dirty = True
+
+    def predict_section(self, spec: dict):
+        """
+        Runner section expected after registration.
+        """
+        section = {
+            "name": spec["name"],
+            "url": self.api_url,
+            "token": spec["token"],
+        }
+        merge_dict(section, self.make_runner_section(spec))
+        return section
+
+    def dump_diff(self, content: dict):
+        if content is None:
+            return ""
+        return self.dump_toml(mask_secrets(content))
+
+    def make_diff(self, plans: list):
+        """
+        Before and after text of affected runner sections and globals.
+        Built from loaded config before any change is done.
+        """
+        diffs = []
+        for spec, plan in zip(self.specs, plans):
+            action = plan["action"]
+            if action == RunnerAction.NOOP:
+                continue
+            section = self.find_section(spec)
+            after = None
+            if action in (RunnerAction.REGISTER, RunnerAction.REREGISTER):
+                after = self.predict_section(spec)
+            elif action == RunnerAction.UPDATE:
+                after = self.merge_section(copy.deepcopy(section), spec)
+            header = f"{RUNNER_CONFIG} [[runners]] {spec['name']}"
+            diffs.append(
+                {
+                    "before_header": header,
+                    "after_header": header,
+                    "before": self.dump_diff(section and {"runners": [section]}),
+                    "after": self.dump_diff(after and {"runners": [after]}),
+                },
+            )
+
+        globals_before = {k: v for k, v in self.config.items() if k != "runners"}
+        globals_after = None
+        if self.global_params and self.global_params_mode == "merge":
+            globals_after = merge_dict(
+                copy.deepcopy(globals_before),
+                copy.deepcopy(self.global_params),
+            )
+        elif self.get_start_globals() and self.start_config_planned(plans):
+            # Start config replaces whole file
+            globals_after = self.get_start_globals()
+        if globals_after is not None and globals_after != globals_before:
+            header = f"{RUNNER_CONFIG} globals"
+            diffs.append(
+                {
+                    "before_header": header,
+                    "after_header": header,
+                    "before": self.dump_diff(globals_before),
+                    "after": self.dump_diff(globals_after),
+                },
+            )
+        return diffs
+
+    def start_config_planned(self, plans: list):
+        """
+        Check whether replace mode writes start config while planned
+        actions are done. It's written on registration once config holds
+        no runner sections, i.e. after reregister unregistered the last one.
+        """
+        if self.global_params_mode != "replace":
+            return False
+        remaining = {section.get("name") for section in self.config.get("runners", [])}
+        for spec, plan in zip(self.specs, plans):
+            action = plan["action"]
+            section = self.find_section(spec)
+            unregistering = action == RunnerAction.UNREGISTER or (
+                action == RunnerAction.REREGISTER and not self.make_before_break
+            )
+            if unregistering and section is not None:
+                remaining.discard(section.get("name"))
+            if action in (RunnerAction.REGISTER, RunnerAction.REREGISTER):
+                if not remaining:
+                    return True
+                remaining.add(spec["name"])
+        return False
+
+    def plan(self, spec: dict):
+        """
+        Decide what to do with single runner. Nothing is changed here.
+        """
+        plan = {
+            "state_before": self.get_state(spec),
+            "action": RunnerAction.NOOP,
+            "msg": None,
+        }
+        state_before = plan["state_before"]
+
+        if spec["state"] == "present":
+            if state_before == RunnerState.UNREGISTERED:
+                plan["action"] = RunnerAction.REGISTER
+                plan["msg"] = "Init registering Runner"
+
+            elif state_before == RunnerState.TOKEN_MISMATCH:
+                plan["action"] = RunnerAction.REREGISTER
+                plan["msg"] = "Reregistering Runner due to Token mismatch"
+
+            elif state_before == RunnerState.REGISTERED:
+                if spec["recreate"]:
+                    plan["action"] = RunnerAction.REREGISTER
+                    plan["msg"] = (
+                        "Force reregistering Runner due to recreate option"
+                    )
+                elif self.update_in_place and self.section_differs(spec):
+                    plan["action"] = RunnerAction.UPDATE
+                    plan["msg"] = "Updating Runner config in place"
+                if self.update_in_place:
+                    self.check_unapplied_envs(spec)
+
+        elif spec["state"] == "absent":
+            if state_before == RunnerState.REGISTERED:
+                plan["action"] = RunnerAction.UNREGISTER
+                plan["msg"] = "Unregistering Runner"
+
+        return plan
+
+    def execute(self, spec: dict, plan: dict):
+        """
+        Bring single runner to desired state according to plan.
+        """
+        action = plan["action"]
+        if action == RunnerAction.REGISTER:
+            self.do_enable(spec)
+        elif action == RunnerAction.REREGISTER:
+            self.do_reenable(spec)
+        elif action == RunnerAction.UPDATE:
+            self.pending_updates.append(spec)
+        elif action == RunnerAction.UNREGISTER:
+            self.do_disable(spec)
+
+    def make_result(self, spec: dict, plan: dict):
+        """
+        Per runner result. Planned state is reported in check mode.
+        """
+        state_before = plan["state_before"]
+        state_after = ACTION_STATES.get(plan["action"], state_before)
+        result = {
+            "name": spec["name"],
+            "action": plan["action"].value,
+            "runner_state": state_after.value,
+            "changed": state_before != state_after,
+        }
+        if plan["msg"]:
+            result["msg"] = plan["msg"]
+        if spec.get("token_check"):
+            result["token_check"] = spec["token_check"]
+        if spec.get("drain"):
+            result["drain"] = spec["drain"]
+        if spec.get("retry_attempts"):
+            result["retry_attempts"] = spec["retry_attempts"]
+            result["backoff_time"] = round(spec["backoff_time"], 6)
+        return result
+
+    def act(self):
+        """
+        Main logic entrypoint.
+        """
+        inputs_hash = None
+        if self.skip_unchanged and not any(s["recreate"] for s in self.specs):
+            inputs_hash = self.get_inputs_hash()
+            results = self.get_unchanged_results(inputs_hash)
+            self.command_results["cache_hit"] = results is not None
+            if results is not None:
+                self.exit_with(results)
+
+        self.bin = self.get_binary()
+        self.check_service()
+        # Lock file is placed in directory service creates
+        self.wait_system_id()
+        if not self.module.check_mode:
+            self.acquire_lock()
+
+        if self.verify_config_exists():
+            self.set_config(self.load_config_identities())
+
+        journal = self.load_journal()
+        if journal is not None:
+            self.resume_journal(journal)
+
+        if self.module._diff:
+            # Whole content is needed to show sections
+            self.refresh_config()
+
+        plans = [self.plan(spec) for spec in self.specs]
+        if self.module._diff:
+            self.command_results["diff"] = self.make_diff(plans)
+        try:
+            results = self.apply(plans, inputs_hash)
+        except Exception as e:
+            # Unexpected errors are handled as failures once config is
+            # about to change, so they're rolled back if requested
+            if self.journal is None:
+                raise
+            self.fail(
+                msg=f"Unexpected error while applying changes: {to_text(e)}",
+                exception=traceback.format_exc(),
+            )
+        self.exit_with(results)
+
+    def apply(self, plans: list, inputs_hash: str):
+        """
+        Do planned actions and save state of run.
+        Return per runner results.
+        """
+        if not self.module.check_mode:
+            if self.verify_token:
+                # All tokens are checked before the first runner is touched
+                for spec, plan in zip(self.specs, plans):
+                    if plan["action"] == RunnerAction.REREGISTER:
+                        self.check_token(spec)
+            if any(plan["action"] != RunnerAction.NOOP for plan in plans):
+                self.begin_journal(plans)
+            for spec, plan in zip(self.specs, plans):
+                self.execute(spec, plan)
+                if plan["action"] != RunnerAction.NOOP:
+                    self.journal_done(spec)
+            self.update_runner_sections()
+
+        if self.global_params_mode == "merge":
+            self.command_results["globals_updated"] = self.merge_global_params()
+
+        results = [
+            self.make_result(spec, plan) for spec, plan in zip(self.specs, plans)
+        ]
+        if not self.module.check_mode:
+            self.flush_config()
+            self.save_token_cache()
+            if self.update_in_place:
+                self.save_applied(results)
+            if inputs_hash:
+                self.save_state(inputs_hash, results)
+            self.end_journal()
+            if self.reload and self.config_changed:
+                self.reload_service()
+        return results
+
+    def exit_with(self, results: list):
+        """
+        Exit module with per runner results.
+        """
+        self.command_results.update(self.get_stats())
+        self.command_results["runners"] = results
+        if self.module.params["name"]:
+            self.command_results["runner_state"] = results[0]["runner_state"]
+            if "msg" in results[0]:
+                self.command_results["msg"] = results[0]["msg"]
 
         if self.warnings:
             self.command_results["warnings"] = self.warnings
 
-        self.command_results["changed"] = (
-            state_before.value != self.command_results["runner_state"]
-        )
+        changed = any(result["changed"] for result in results)
+        if self.command_results.get("globals_updated"):
+            changed = True
+        self.command_results["changed"] = changed
 
         self.module.exit_json(**self.command_results)
 
 
 def main():
+    profiler = None
+    if os.environ.get(PROFILE_ENV):
+        profiler = cProfile.Profile()
+        profiler.enable()
+
     module = setup_module_object()
-    if not HAS_TOML:
-        module.fail_json(
-            msg=missing_required_lib("toml"),
-            exception=TOML_IMP_ERR,
-        )
+    gitlab_runner = Runner(module, profiler)
+    try:
+        gitlab_runner.act()
+    finally:
+        gitlab_runner.release_lock()
+
+
+def import_toml_lib(names: tuple):
+    """
+    Import first available TOML lib of given ones.
+    Return its name and module or (None, None).
+    """
+    for name in names:
+        if name not in TOML_LIBS:
+            try:
+                TOML_LIBS[name] = importlib.import_module(name)
+            except ImportError:
+                TOML_LIBS[name] = None
+        if TOML_LIBS[name] is not None:
+            return name, TOML_LIBS[name]
+    return None, None
+
+
+def scan_runner_sections(path: str):
+    """
+    Find name and token of every runner section with mmap scan of config
+    file. Other content isn't materialized. Return None if file has
+    something scanner isn't sure about, whole parse is required then.
+    """
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return scan_runner_headers(data)
+    except (OSError, ValueError):
+        return None
+
+
+def scan_runner_headers(data):
+    headers = [m.end() for m in RUNNER_HEADER_RE.finditer(data)]
+    if not headers and data.find(b"runners") != -1:
+        # Runners are defined in some other form
+        return None
+
+    sections = []
+    for start in headers:
+        # Identity keys are placed before first sub-table of section
+        table = TABLE_HEADER_RE.search(data, start)
+        end = table.start() if table else len(data)
+        section = {}
+        for m in RUNNER_IDENTITY_RE.finditer(data, start, end):
+            key = m.group(1).decode()
+            if key in section:
+                # Line of multi-line string, e.g. script setting name=
+                return None
+            section[key] = decode_toml_string(m.group(2))
+        if len(section) != 2:
+            return None
+        sections.append(section)
+    return sections
+
+
+def decode_toml_string(value: bytes):
+    """
+    Decode basic or literal TOML string.
+    Raise ValueError on escapes JSON doesn't know.
+    """
+    if value.startswith(b"'"):
+        return value[1:-1].decode()
+    return json.loads(value)
+
+
+def mask_secrets(data):
+    """
+    Copy of data with tokens and secrets masked.
+    """
+    if isinstance(data, dict):
+        masked = {}
+        for key, value in data.items():
+            if isinstance(value, str) and SECRET_KEY_RE.search(key):
+                masked[key] = SECRET_MASK
+            else:
+                masked[key] = mask_secrets(value)
+        return masked
+    if isinstance(data, list):
+        return [mask_secrets(item) for item in data]
+    return data
+
+
+def read_pids(path: str):
+    """
+    Read PIDs from pid file or cgroup procs file.
+    """
+    try:
+        with open(path) as f:
+            return [int(line) for line in f.read().split() if line.isdigit()]
+    except OSError:
+        return []
+
+
+def is_service_process(pid: int):
+    """
+    Check that process is 'gitlab-runner run' of this host using managed
+    config. Runners of containers are visible in /proc too, but they live
+    in other PID namespace.
+    """
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            argv = f.read().split(b"\0")
+    except OSError:
+        return False
+    if b"gitlab-runner" not in os.path.basename(argv[0]) or b"run" not in argv[1:]:
+        return False
+    # Service without config option uses default one
+    config = get_command_option(argv[1:], (b"--config", b"-c"))
+    if config is not None:
+        if os.path.normpath(config) != os.path.normpath(to_bytes(RUNNER_CONFIG)):
+            return False
+    return same_pid_namespace(pid)
+
+
+def get_command_option(args: list, names: tuple):
+    """
+    Value of command line option given as '--name value' or '--name=value'.
+    """
+    for index, arg in enumerate(args):
+        if arg in names:
+            return args[index + 1] if index + 1 < len(args) else None
+        for name in names:
+            if arg.startswith(name + b"="):
+                return arg[len(name) + 1 :]
+    return None
+
+
+def same_pid_namespace(pid: int):
+    """
+    Check that process shares PID namespace of module. Namespace is
+    considered shared if it can't be read for module itself.
+    """
+    try:
+        own = os.readlink("/proc/self/ns/pid")
+    except OSError:
+        return True
+    try:
+        return os.readlink(f"/proc/{pid}/ns/pid") == own
+    except OSError:
+        return False
+
+
+def read_metric(url: str, name: str, match=None):
+    """
+    Sum of samples of Prometheus metric of given name.
+    Return None if metrics endpoint can't be read.
+    """
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(
+        parts.hostname,
+        parts.port,
+        timeout=METRICS_TIMEOUT,
+    )
+    try:
+        conn.request("GET", parts.path or "/metrics")
+        response = conn.getresponse()
+        data = to_text(response.read())
+    except (OSError, http.client.HTTPException):
+        return None
+    finally:
+        conn.close()
+    if response.status != 200:
+        return None
+    return parse_metric(data, name, match)
+
+
+def parse_metric(data: str, name: str, match=None):
+    """
+    Sum of samples of metric in Prometheus text format.
+    If match is given only samples whose labels it accepts are counted.
+    """
+    pattern = re.compile(rf"^{re.escape(name)}(?:{{([^}}]*)}})?[ \t]+(\S+)", re.M)
+    total = 0.0
+    for m in pattern.finditer(data):
+        labels = dict(METRIC_LABEL_RE.findall(m.group(1) or ""))
+        if match is not None and not match(labels):
+            continue
+        try:
+            total += float(m.group(2))
+        except ValueError:
+            pass
+    return total
 
-    gitlab_runner = Runner(module)
-    gitlab_runner.act()
+
+def is_runner_label(label: str, token: str):
+    """
+    Check that runner label of metrics belongs to runner of given token.
+    Label is short token as gitlab-runner makes it for logs and metrics.
+    """
+    for prefix in RUNNER_TOKEN_PREFIXES:
+        if token.startswith(prefix):
+            token = token[len(prefix) :]
+            break
+    if not label or len(label) < min(RUNNER_SHORT_TOKEN_LENGTH, len(token)):
+        return False
+    return token.startswith(label)
+
+
+def find_service_pid():
+    """
+    Find running gitlab-runner service process without running commands.
+    Return name of backend which found it and PID or (None, None).
+    """
+    for path in RUNNER_SERVICE_CGROUPS:
+        for pid in read_pids(path):
+            if is_service_process(pid):
+                return "cgroup", pid
+
+    for path in RUNNER_PID_FILES:
+        for pid in read_pids(path):
+            if is_service_process(pid):
+                return "pidfile", pid
+
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        entries = []
+    for entry in entries:
+        if entry.isdigit() and is_service_process(int(entry)):
+            return "proc", int(entry)
+
+    return None, None
+
+
+def file_ready(path: str):
+    """
+    Check that file exists and has content.
+    """
+    try:
+        return os.stat(path).st_size > 0
+    except OSError:
+        return False
+
+
+def wait_for_file(path: str, timeout: float):
+    """
+    Wait until file exists and has content or timeout expires.
+    Return name of backend used, inotify or poll.
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        fd = -1
+
+    if fd >= 0:
+        try:
+            mask = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO
+            directory = os.path.dirname(path).encode()
+            if libc.inotify_add_watch(fd, directory, mask) >= 0:
+                # File could be created before watch is added
+                while not file_ready(path):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    if select.select([fd], [], [], remaining)[0]:
+                        drain_inotify(fd)
+                return "inotify"
+        finally:
+            os.close(fd)
+
+    # Directory itself is missing or inotify isn't available
+    while not file_ready(path):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(SYSTEM_ID_POLL_INTERVAL, remaining))
+    return "poll"
+
+
+def drain_inotify(fd: int):
+    """
+    Read pending events. Only the fact of change matters.
+    """
+    try:
+        while os.read(fd, 4096):
+            pass
+    except OSError as e:
+        if e.errno != errno.EAGAIN:
+            raise
+
+
+def parse_api_time(value: str):
+    """
+    Convert API timestamp to datetime as gitlab-runner stores it.
+    """
+    if not value:
+        return RUNNER_TOKEN_NO_EXPIRE
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return value
+
+
+def parse_retry_after(value: str):
+    """
+    Seconds of Retry-After header. HTTP date form isn't used by Gitlab.
+    """
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def hash_token(token: str):
+    """
+    Token is never stored as is.
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def make_sub_spec(spec: dict, **kwargs):
+    """
+    Copy of runner spec for intermediate step with own retry counters.
+    """
+    sub_spec = dict(spec, current_name=None, retry_attempts=0, backoff_time=0)
+    sub_spec.update(kwargs)
+    return sub_spec
+
+
+def merge_dict(dst: dict, src: dict):
+    """
+    Recursively merge src into dst. Keys absent in src are kept.
+    """
+    for key, value in src.items():
+        if isinstance(value, dict) and isinstance(dst.get(key), dict):
+            merge_dict(dst[key], value)
+        else:
+            dst[key] = value
+    return dst
+
+
+def three_way_merge(live: dict, desired: dict, applied: dict):
+    """
+    Apply desired keys to live dict. Keys of last applied which aren't
+    desired any more are removed. Other keys of live are kept.
+    """
+    for key in applied:
+        if key not in desired:
+            live.pop(key, None)
+    for key, value in desired.items():
+        if isinstance(value, dict) and isinstance(live.get(key), dict):
+            previous = applied.get(key)
+            if not isinstance(previous, dict):
+                previous = {}
+            three_way_merge(live[key], value, previous)
+        else:
+            live[key] = copy.deepcopy(value)
+    return live
+
+
+def make_env_section(environ_vars: dict):
+    """
+    Runner keys set by known registration ENVs.
+    Return them and ENVs which aren't known.
+    """
+    section = {}
+    unknown = {}
+    for name, value in (environ_vars or {}).items():
+        if name not in RUNNER_ENV_KEYS:
+            unknown[name] = value
+            continue
+        path, kind = RUNNER_ENV_KEYS[name]
+        table = section
+        for key in path[:-1]:
+            table = table.setdefault(key, {})
+        try:
+            table[path[-1]] = convert_env_value(value, kind)
+        except ValueError:
+            unknown[name] = value
+    return section, unknown
+
+
+def convert_env_value(value, kind: type):
+    """
+    Convert ENV value as gitlab-runner parses it.
+    """
+    if kind is bool:
+        if isinstance(value, bool):
+            return value
+        return to_text(value).lower() in ("1", "t", "true")
+    if kind is str and isinstance(value, bool):
+        return "true" if value else "false"
+    return kind(value)
+
+
+def drop_none(data):
+    """
+    Copy of data without None values of dicts and lists.
+    """
+    if isinstance(data, dict):
+        return {k: drop_none(v) for k, v in data.items() if v is not None}
+    if isinstance(data, list):
+        return [drop_none(item) for item in data if item is not None]
+    return data
+
+
+def is_subset(src: dict, dst: dict):
+    """
+    Check that every key of src is present in dst with same value.
+    """
+    for key, value in src.items():
+        if isinstance(value, dict) and isinstance(dst.get(key), dict):
+            if not is_subset(value, dst[key]):
+                return False
+        elif key not in dst or dst[key] != value:
+            return False
+    return True
 
 
 def get_default_globals():
@@ -480,6 +3097,21 @@ def get_default_globals():
     return params
 
 
+def make_runner_spec():
+    spec = dict(
+        name=dict(required=True, type="str"),
+        token=dict(required=True, type="str", no_log=True),
+        state=dict(choices=["present", "absent"]),
+        executor=dict(type="str"),
+        default_image=dict(type="str"),
+        environ_vars=dict(type="dict"),
+        template_file=dict(type="str"),
+        recreate=dict(type="bool"),
+        runner_params=dict(type="dict"),
+    )
+    return spec
+
+
 def make_argument_spec():
     spec = dict(
         api_url=dict(required=True, type="str"),
@@ -487,14 +3119,39 @@ def make_argument_spec():
             choices=["present", "absent"],
             default="present",
         ),
-        token=dict(required=True, type="str", no_log=True),
-        name=dict(required=True, type="str"),
+        token=dict(type="str", no_log=True),
+        name=dict(type="str"),
+        runners=dict(type="list", elements="dict", options=make_runner_spec()),
         executor=dict(type="str"),
         default_image=dict(type="str"),
-        global_params=dict(type="dict", default=get_default_globals()),
+        global_params=dict(type="dict"),
         environ_vars=dict(type="dict"),
         template_file=dict(type="str"),
         recreate=dict(type="bool", default=False),
+        runner_params=dict(type="dict"),
+        global_params_mode=dict(choices=["replace", "merge"], default="replace"),
+        update_in_place=dict(type="bool", default=False),
+        skip_unchanged=dict(type="bool", default=False),
+        service_probe=dict(choices=["auto", "status"], default="auto"),
+        profile_dir=dict(type="path"),
+        profile_top=dict(type="int", default=20),
+        backend=dict(choices=["binary", "api"], default="binary"),
+        verify_token=dict(type="bool", default=False),
+        token_cache_ttl=dict(type="int", default=3600),
+        validate_certs=dict(type="bool", default=True),
+        rollback_on_failure=dict(type="bool", default=False),
+        drain_timeout=dict(type="float", default=0),
+        drain_pause=dict(choices=["config", "api"], default="config"),
+        api_token=dict(type="str", no_log=True),
+        make_before_break=dict(type="bool", default=False),
+        reload_service=dict(type="bool", default=False),
+        reload_timeout=dict(type="float", default=10),
+        metrics_url=dict(type="str"),
+        system_id_timeout=dict(type="float", default=60),
+        lock_timeout=dict(type="float", default=300),
+        retries=dict(type="int", default=0),
+        retry_delay=dict(type="float", default=1),
+        retry_max_delay=dict(type="float", default=30),
     )
     return spec
 
@@ -502,14 +3159,10 @@ def make_argument_spec():
 def setup_module_object():
     module = AnsibleModule(
         argument_spec=make_argument_spec(),
-        supports_check_mode=False,
-        required_one_of=[
-            [
-                "executor",
-                "template_file",
-                "environ_vars",
-            ],
-        ],
+        supports_check_mode=True,
+        required_one_of=[["name", "runners"]],
+        required_together=[["name", "token"]],
+        mutually_exclusive=[["name", "runners"], ["token", "runners"]],
     )
     return module
 
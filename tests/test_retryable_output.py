@@ -0,0 +1,42 @@
+import pytest
+
+import gitlab_runner_register as module
+
+RUNTIME_PLATFORM = (
+    "Runtime platform                                    arch=amd64 os=linux "
+    "pid=502 revision=81ab07f6 version=16.10.0\n"
+)
+
+
+@pytest.mark.parametrize(
+    "stderr",
+    [
+        "ERROR: Registering runner... failed  runner=abcdefgh "
+        "status=POST https://gitlab.example.com/api/v4/runners/verify: "
+        "429 Too Many Requests\n",
+        "ERROR: Registering runner... failed  runner=abcdefgh "
+        "status=502 Bad Gateway\n",
+        "ERROR: Verifying runner... failed  runner=abcdefgh "
+        "status=couldn't execute POST against https://gitlab.example.com: "
+        "dial tcp 10.0.0.1:443: connect: connection refused\n",
+    ],
+)
+def test_transient_errors_are_retryable(stderr):
+    error = module.CommandError(1, "", RUNTIME_PLATFORM + stderr)
+    assert error.retryable
+
+
+@pytest.mark.parametrize(
+    "stderr",
+    [
+        "ERROR: Registering runner... failed  runner=abcdefgh "
+        "status=403 Forbidden\n",
+        "ERROR: Verifying runner... is removed  runner=abcdefgh\n",
+        "FATAL: Runner configuration other than name and executor "
+        "configuration is reserved\n",
+    ],
+)
+def test_permanent_errors_arent_retryable(stderr):
+    # pid=502 of runtime platform line isn't a status
+    error = module.CommandError(1, "", RUNTIME_PLATFORM + stderr)
+    assert not error.retryable
@@ -0,0 +1,89 @@
+import pytest
+
+import gitlab_runner_register as module
+
+toml = module.import_toml_lib(module.TOML_READERS)[1]
+
+
+def scan(tmp_path, content: str):
+    path = tmp_path / "config.toml"
+    path.write_text(content, encoding="utf-8")
+    return module.scan_runner_sections(str(path))
+
+
+def parse_identities(content: str):
+    return [
+        {"name": section["name"], "token": section["token"]}
+        for section in toml.loads(content).get("runners", [])
+    ]
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "",
+        "concurrent = 1\n",
+        'concurrent = 1\n\n[[runners]]\n  name = "a"\n  token = "glrt-a"\n',
+        # Layout written by gitlab-runner: identity keys, then sub-tables
+        '[[runners]]\n  name = "a"\n  url = "https://gitlab.example.com"\n'
+        '  id = 1\n  token = "glrt-a"\n  executor = "docker"\n'
+        "  [runners.cache]\n    [runners.cache.s3]\n"
+        '  [runners.docker]\n    image = "alpine"\n'
+        '    volumes = ["/cache", "/var/run/docker.sock:/var/run/docker.sock"]\n'
+        '[[runners]]\n  name = "b"\n  token = "glrt-b"\n',
+        # Names of nested array of tables don't belong to runner
+        '[[runners]]\n  name = "a"\n  token = "glrt-a"\n'
+        '  [[runners.docker.services]]\n    name = "postgres:16"\n'
+        '[[runners]]\n  name = "b"\n  token = "glrt-b"\n',
+        "[[runners]] # comment\n  name = 'a\\b' # literal string\n"
+        "  token = 'glrt-a'\n",
+        '[[runners]]\n  name = "caf\\u00e9 \\"x\\""\n  token = "glrt-a"\n',
+    ],
+)
+def test_scan_matches_full_parse(tmp_path, content):
+    assert scan(tmp_path, content) == parse_identities(content)
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        # Escape JSON doesn't know
+        '[[runners]]\n  name = "caf\\U000000e9"\n  token = "glrt-a"\n',
+        # Keys after sub-table belong to it, runner has no identity here
+        '[[runners]]\n  name = "a"\n  [runners.docker]\n  token = "glrt-a"\n',
+        # Line of nested array looks like table header
+        '[[runners]]\n  allowed = [\n    ["a", "b"],\n  ]\n'
+        '  name = "a"\n  token = "glrt-a"\n',
+        # Runners aren't array of tables
+        'runners = [{name = "a", token = "glrt-a"}]\n',
+        '[[runners]]\n  name = """a"""\n  token = "glrt-a"\n',
+        # Script of multi-line string sets name
+        '[[runners]]\n  name = "a"\n  token = "glrt-a"\n'
+        '  pre_build_script = """\n  name = "x"\n"""\n',
+    ],
+)
+def test_scan_falls_back(tmp_path, content):
+    # Content is valid TOML which is left to full parse
+    toml.loads(content)
+    assert scan(tmp_path, content) is None
+
+
+def test_scan_missing_file(tmp_path):
+    assert module.scan_runner_sections(str(tmp_path / "config.toml")) is None
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [
+        (b'"glrt-a"', "glrt-a"),
+        (b"'C:\\runner'", "C:\\runner"),
+        (b'"tab\\there"', "tab\there"),
+    ],
+)
+def test_decode_toml_string(value, expected):
+    assert module.decode_toml_string(value) == expected
+
+
+def test_decode_toml_string_unknown_escape():
+    with pytest.raises(ValueError):
+        module.decode_toml_string(b'"\\U0001F600"')
@@ -0,0 +1,140 @@
+import copy
+
+import pytest
+
+import gitlab_runner_register as module
+
+
+def test_merge_removes_keys_no_longer_desired():
+    live = {"executor": "docker", "limit": 2, "output_limit": 8192}
+    applied = {"executor": "docker", "limit": 2, "output_limit": 8192}
+    desired = {"executor": "docker", "limit": 4}
+
+    merged = module.three_way_merge(live, desired, applied)
+
+    assert merged == {"executor": "docker", "limit": 4}
+
+
+def test_merge_keeps_keys_added_by_gitlab_runner():
+    # Keys of live section which module never applied
+    live = {
+        "executor": "docker",
+        "limit": 2,
+        "custom_build_dir": {},
+        "cache": {"MaxUploadedArchiveSize": 0},
+        "docker": {"image": "alpine:3.19", "volumes": ["/cache"], "shm_size": 0},
+    }
+    applied = {"executor": "docker", "limit": 2, "docker": {"image": "alpine:3.19"}}
+    desired = {"executor": "docker", "docker": {"image": "alpine:3.20"}}
+
+    merged = module.three_way_merge(live, desired, applied)
+
+    assert merged == {
+        "executor": "docker",
+        "custom_build_dir": {},
+        "cache": {"MaxUploadedArchiveSize": 0},
+        "docker": {"image": "alpine:3.20", "volumes": ["/cache"], "shm_size": 0},
+    }
+
+
+def test_merge_removes_nested_keys_no_longer_desired():
+    live = {"docker": {"image": "alpine", "privileged": True, "volumes": ["/cache"]}}
+    applied = {"docker": {"image": "alpine", "privileged": True}}
+    desired = {"docker": {"image": "alpine"}}
+
+    merged = module.three_way_merge(live, desired, applied)
+
+    assert merged == {"docker": {"image": "alpine", "volumes": ["/cache"]}}
+
+
+def test_merge_removes_whole_table_no_longer_desired():
+    live = {"executor": "kubernetes", "kubernetes": {"namespace": "ci"}}
+    applied = {"executor": "kubernetes", "kubernetes": {"namespace": "ci"}}
+    desired = {"executor": "shell"}
+
+    merged = module.three_way_merge(live, desired, applied)
+
+    assert merged == {"executor": "shell"}
+
+
+def test_merge_without_applied_keeps_live_keys():
+    # First run after upgrade: nothing is known to be applied
+    live = {"executor": "docker", "limit": 2}
+    desired = {"output_limit": 8192}
+
+    merged = module.three_way_merge(live, desired, {})
+
+    assert merged == {"executor": "docker", "limit": 2, "output_limit": 8192}
+
+
+def test_merge_replaces_value_of_other_type():
+    live = {"docker": "broken", "environment": ["A=1"]}
+    applied = {"environment": ["A=1"]}
+    desired = {"docker": {"image": "alpine"}, "environment": ["A=1", "B=2"]}
+
+    merged = module.three_way_merge(live, desired, applied)
+
+    assert merged == {"docker": {"image": "alpine"}, "environment": ["A=1", "B=2"]}
+
+
+def test_merge_doesnt_share_desired_values():
+    desired = {"environment": ["A=1"], "docker": {"volumes": ["/cache"]}}
+    merged = module.three_way_merge({}, desired, {})
+    merged["environment"].append("B=2")
+
+    assert desired == {"environment": ["A=1"], "docker": {"volumes": ["/cache"]}}
+
+
+def test_merge_is_idempotent():
+    live = {"executor": "docker", "limit": 2, "cache": {"Type": "s3"}}
+    applied = {"limit": 2, "cache": {"Type": "s3"}}
+    desired = {"limit": 3, "cache": {"Shared": True}}
+
+    once = module.three_way_merge(copy.deepcopy(live), desired, applied)
+    twice = module.three_way_merge(copy.deepcopy(once), desired, desired)
+
+    expected = {"executor": "docker", "limit": 3, "cache": {"Shared": True}}
+    assert once == twice == expected
+
+
+def test_env_section_maps_known_envs():
+    section, unknown = module.make_env_section(
+        {
+            "RUNNER_LIMIT": "4",
+            "DOCKER_IMAGE": "alpine",
+            "DOCKER_PRIVILEGED": "true",
+            "CACHE_SHARED": False,
+            "DOCKER_CPUS": 2,
+        },
+    )
+
+    assert section == {
+        "limit": 4,
+        "docker": {"image": "alpine", "privileged": True, "cpus": "2"},
+        "cache": {"Shared": False},
+    }
+    assert unknown == {}
+
+
+def test_env_section_returns_unknown_envs():
+    section, unknown = module.make_env_section(
+        {"RUNNER_TAG_LIST": "a,b", "RUNNER_LIMIT": "many", "RUNNER_SHELL": "bash"},
+    )
+
+    assert section == {"shell": "bash"}
+    assert unknown == {"RUNNER_TAG_LIST": "a,b", "RUNNER_LIMIT": "many"}
+
+
+@pytest.mark.parametrize(
+    ("value", "kind", "expected"),
+    [
+        ("1", bool, True),
+        ("t", bool, True),
+        ("False", bool, False),
+        ("yes", bool, False),
+        (True, str, "true"),
+        ("10", int, 10),
+    ],
+)
+def test_convert_env_value(value, kind, expected):
+    assert module.convert_env_value(value, kind) == expected